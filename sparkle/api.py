@@ -17,23 +17,74 @@ __all__ = ['make_sparkle_app']
 from sqlalchemy.exc import DatabaseError
 from werkzeug.exceptions import Forbidden, NotFound, Unauthorized
 from simplejson import loads, dumps
+from twisted.internet import reactor
 from functools import wraps
 from os.path import dirname
-from time import time
+from time import time, sleep
+from datetime import datetime
+from random import uniform
+from copy import deepcopy
 from collections import Mapping
 
 from sparkle.common import *
-from sparkle.util import call_sync, remove_nulls
+from sparkle.util import call_sync, remove_nulls, is_serialization_failure
 from sparkle.schema import schema
 from sparkle.rest import Flaskful, json_response
 from sparkle.auth import sign_token
 from sparkle.validate import validate_json_patch, validate_dbdict_fragment
 from sparkle.patch import Pointer, normalize_path
-from sparkle.dbdict import preprocess_patch, Children
+from sparkle.dbdict import preprocess_patch, patch_rows, Children, RowCache
 
 import flask
 
 
+# Seconds to wait for committed changes to reach the model.
+WRITE_TIMEOUT = 30.0
+
+# Maximum number of rows returned per page of history.
+HISTORY_LIMIT = 1000
+
+# How many times to retry patches that conflicted with other transactions
+# and the initial delay between the attempts, doubled after every one.
+WRITE_RETRIES = 5
+RETRY_DELAY = 0.05
+
+
+# Accepted formats of timestamps in query arguments.
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+]
+
+
+def parse_timestamp(value, path):
+    """Parse ISO 8601 timestamp from a query argument."""
+
+    value = value.rstrip('Z')
+
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise DataError('invalid timestamp', path)
+
+
+def parse_limit(value, path):
+    """Parse page size from a query argument, clamped to a valid range."""
+
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise DataError('invalid limit', path)
+
+    return max(1, min(limit, HISTORY_LIMIT))
+
+
 def path_to_rule(path):
     """Convert list with path components to routing rule for Flask."""
 
@@ -80,65 +131,97 @@ def convert_errors(fn):
     return wrapper
 
 
-def make_sparkle_app(manager):
-    """Construct Sparkle RESTful API site."""
+def apply_patch(manager, patch):
+    """
+    Preprocess and apply validated JSON Patch to database.
+    Returns dictionary with placeholder to uuid mappings.
 
-    app = Flaskful(__name__)
-    app.debug = True
-
-    def apply_patch(patch):
-        """
-        Preprocess and apply validated JSON Patch to database.
-        Returns dictionary with placeholder to uuid mappings.
-        """
+    Transactions that fail due to concurrent modifications are
+    retried after a random delay, every time with a fresh copy
+    of the patch.
+    """
 
+    for attempt in xrange(WRITE_RETRIES + 1):
         try:
-            # Get root of the database dictionary mapping.
-            root = Children(manager.db, schema.root)
+            return attempt_patch(manager, deepcopy(patch))
+        except DatabaseError, e:
+            if not is_serialization_failure(e):
+                raise
+
+            tables = set(name for name, pkey in patch_rows(patch))
+            exhausted = attempt == WRITE_RETRIES
+            reactor.callFromThread(manager.record_write_conflict,
+                                   tables, exhausted)
 
-            # Convert placeholders in the input patch to actual uuids.
-            # Returns mapped placeholders for client to orient himself.
-            uuids = preprocess_patch(root, patch)
+            if exhausted:
+                raise ConflictError('conflicting concurrent modification, '
+                                    'try again later', [])
 
-            # Apply the patch.
-            Pointer(root).patch(patch)
+            sleep(uniform(0, RETRY_DELAY * 2 ** attempt))
 
-            # Determine our transaction id.
-            txid = int(manager.db.execute('SELECT cork();').fetchone()[0])
 
-            # Register our completion watch.
-            call_sync(manager.listener.register, txid)
+def attempt_patch(manager, patch):
+    """
+    Apply the patch in a single transaction.
+    Serialization failures are propagated as they are.
+    """
 
+    try:
+        # Get root of the database dictionary mapping.
+        cache = RowCache(manager.db, prepared=manager.prepared_statements)
+        root = Children(manager.db, schema.root, cache=cache)
+
+        # Convert placeholders in the input patch to actual uuids.
+        # Returns mapped placeholders for client to orient himself.
+        uuids = preprocess_patch(root, patch)
+
+        # Apply the patch.
+        Pointer(root).patch(patch)
+
+        # Determine our transaction id.
+        txid = int(manager.db.execute('SELECT cork();').fetchone()[0])
+
+        # Register our completion watch.  The listener is thread-safe,
+        # so we do not need to bother the reactor at all.
+        manager.listener.register(txid)
+
+        try:
             try:
-                try:
-                    # Attempt to commit the transaction.
-                    manager.db.commit()
-                except DatabaseError, e:
-                    # We have nothing better for now.
-                    raise DataError(e.orig.diag.message_primary, [])
-            except:
-                # Transaction failed, remove the completion watch.
-                call_sync(manager.listener.abort, txid)
-
-                # Re-raise the exception.
-                raise
+                # Attempt to commit the transaction.
+                manager.db.commit()
+            except DatabaseError, e:
+                # Conflicts are retried by our caller.
+                if is_serialization_failure(e):
+                    raise
 
-            # Wait for the transaction to propagate.
-            call_sync(manager.listener.wait, txid)
+                # We have nothing better for now.
+                raise DataError(e.orig.diag.message_primary, [])
 
+            # Wait for the transaction to propagate.
+            if not manager.listener.wait(txid, WRITE_TIMEOUT):
+                raise TimeoutError('changes have been saved, but did '
+                                   'not propagate in time')
+        finally:
             # Stop waiting for the transaction.
-            call_sync(manager.listener.abort, txid)
+            manager.listener.abort(txid)
+
+        # Return mapped uuids to the client now, when all data safely
+        # hit the model and he will be able to retrieve them.
+        return uuids
 
-            # Return mapped uuids to the client now, when all data safely
-            # hit the model and he will be able to retrieve them.
-            return uuids
+    except:
+        # Roll back the transaction on any error.
+        manager.db.rollback()
 
-        except:
-            # Roll back the transaction on any error.
-            manager.db.rollback()
+        # Re-raise the exception.
+        raise
 
-            # Re-raise the exception.
-            raise
+
+def make_sparkle_app(manager):
+    """Construct Sparkle RESTful API site."""
+
+    app = Flaskful(__name__)
+    app.debug = True
 
     def make_handlers(path):
         endpoint = schema.resolve_path(path)
@@ -188,7 +271,7 @@ def make_sparkle_app(manager):
                     op['value'] = remove_nulls(op['value'])
 
             # Run the patch and hope for the best?
-            return {'uuids': apply_patch(patch)}
+            return {'uuids': apply_patch(manager, patch)}
 
         @app.require_credentials(manager)
         @convert_errors
@@ -199,6 +282,17 @@ def make_sparkle_app(manager):
                 # Make sure all access control restrictions are applied.
                 validate_dbdict_fragment(credentials, {}, jpath, False)
 
+                # History older than what the model retains is paged
+                # straight from the database.
+                if endpoint.table.retain and 'before' in flask.request.args:
+                    args = flask.request.args
+                    before = parse_timestamp(args['before'], jpath)
+                    limit = parse_limit(args.get('limit', HISTORY_LIMIT),
+                                        jpath)
+
+                    data = manager.list_history(path, keys, before, limit)
+                    return remove_nulls(data)
+
                 try:
                     # Let the manager deal with model access and data
                     # retrieval.  XXX: Access control is broken there, BTW.
@@ -253,7 +347,7 @@ def make_sparkle_app(manager):
                 patch = [{'op': 'add', 'path': post_path, 'value': data}]
 
                 # Apply the patch and return resulting set of UUIDs.
-                return {'uuids': apply_patch(patch)}
+                return {'uuids': apply_patch(manager, patch)}
 
             if 'PATCH' == flask.request.method:
                 return common_patch(credentials, jpath)
@@ -284,7 +378,7 @@ def make_sparkle_app(manager):
                 patch = [{'op': 'remove', 'path': jpath}]
 
                 # Execute as usual.
-                return {'uuids': apply_patch(patch)}
+                return {'uuids': apply_patch(manager, patch)}
 
             if 'PATCH' == flask.request.method:
                 return common_patch(credentials, jpath)
@@ -411,6 +505,15 @@ def make_sparkle_app(manager):
             'role': role
         })
 
+    # Runtime statistics for the administrators.
+    @app.route_json('/v1/stats')
+    @app.require_credentials(manager)
+    def stats(credentials={}):
+        if not credentials.get('alicorn'):
+            raise Forbidden('administrator access required')
+
+        return call_sync(manager.get_stats)
+
     # Endpoint to dump the schema for clients to orient themselves.
     @app.route_json('/v1/schema')
     def dump_schema():
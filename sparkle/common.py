@@ -4,7 +4,7 @@
 from __future__ import unicode_literals
 
 __all__ = ['UserError', 'DataError', 'AccessError', 'PathError',
-           'ConflictError', 'PatchError']
+           'ConflictError', 'PatchError', 'TimeoutError']
 
 
 class UserError(Exception):
@@ -106,4 +106,14 @@ class PatchError(DataError):
     status = 400
 
 
+class TimeoutError(UserError):
+    """
+    Operation did not finish in time.
+    Should map to Gateway Timeout reply to API client.
+    """
+
+    name = 'timeout'
+    status = 504
+
+
 # vim:set sw=4 ts=4 et:
@@ -11,6 +11,12 @@ from simplejson import loads, dumps
 
 
 def make_transparent_type(name):
+    """
+    Create type passed to and from psycopg2 as it is.
+    The type must be stored as ``Transparent<name>`` in this module,
+    so that reflected tables using it can be pickled.
+    """
+
     class TransparentType(UserDefinedType):
         def get_col_spec(self):
             return name
@@ -24,10 +30,15 @@ def make_transparent_type(name):
             def process(value):
                 return value
             return process
+
+    TransparentType.__name__ = str('Transparent' + name)
     return TransparentType
 
-ischema_names['json'] = make_transparent_type('JSON')
-ischema_names['int8range'] = make_transparent_type('INT8RANGE')
+TransparentJSON = make_transparent_type('JSON')
+TransparentINT8RANGE = make_transparent_type('INT8RANGE')
+
+ischema_names['json'] = TransparentJSON
+ischema_names['int8range'] = TransparentINT8RANGE
 
 # Register inet as string type.
 register_type(new_type((869,), 'INET', UNICODE))
@@ -6,13 +6,17 @@ from __future__ import unicode_literals
 import re
 
 from collections import Mapping, MutableMapping, Sequence, MutableSequence
+from collections import OrderedDict
 from pprint import pformat
 from uuid import uuid4
 
+from sqlalchemy import text
+
 from sparkle.common import *
 from sparkle.schema import schema
+from sparkle.pool import get_statement, keys_statement
 
-__all__ = ['preprocess_patch']
+__all__ = ['preprocess_patch', 'patch_rows', 'RowCache']
 
 __doc__ = """
 Database to Dictionary
@@ -33,9 +37,17 @@ We start with a Children(db, schema.root, pkey=None) instance
 and recurse according to schema and database contents.
 For example Collections of Children of a concrete Entity will only
 contain children matched by the parent relation.
+
+All proxies created from a single root share a RowCache, so that rows
+are only loaded once per request no matter how many times the patch
+refers to them.  The root should therefore not outlive the request.
 """
 
 
+# Number of primary keys to fetch at once when listing collections.
+ITER_CHUNK = 1000
+
+
 def is_uuid(uuid):
     if not isinstance(uuid, basestring):
         return False
@@ -99,6 +111,124 @@ def preprocess_patch(children, patch):
     return uuids
 
 
+def fragment_rows(node, fragment, rows):
+    """
+    Collect ``(table, pkey)`` of entities in a fragment of the hierarchy
+    starting at the Children level of given schema node.
+    """
+
+    if not isinstance(fragment, Mapping):
+        return
+
+    for name, entities in fragment.iteritems():
+        endpoint = node.children.get(name)
+
+        if endpoint is None or not isinstance(entities, Mapping):
+            continue
+
+        for pkey, entity in entities.iteritems():
+            rows.add((endpoint.table.name, pkey))
+
+            if isinstance(entity, Mapping):
+                fragment_rows(endpoint, entity.get('children'), rows)
+
+
+def patch_rows(patch):
+    """
+    Return set of ``(table, pkey)`` of all entities the patch refers to,
+    either through it's paths or inside of it's values.
+    """
+
+    rows = set()
+
+    for op in patch:
+        for path, fragment in ((op.get('path'), op.get('value')),
+                               (op.get('from'), None)):
+            if not isinstance(path, list):
+                continue
+
+            for part in reversed(path):
+                fragment = {part: fragment}
+
+            fragment_rows(schema.root, fragment, rows)
+
+    return rows
+
+
+class RowCache(object):
+    """
+    Per-request cache of database rows.
+
+    Rows are cached including their absence, so that repeated probes
+    for non-existent entities do not hit the database either.  Proxies
+    that insert or delete rows must invalidate them.
+
+    With ``prepared`` the connections are expected to have statements
+    from ``sparkle.pool`` prepared and they are used where possible.
+    """
+
+    def __init__(self, db, prepared=False):
+        self.db = db
+        self.rows = {}
+        self.prepared = prepared
+
+    def exists(self, table, pkey):
+        """
+        Determine whether the row exists.  Always asks the database,
+        since the model might not have caught up with it yet.
+        """
+
+        return self.get(table, pkey) is not None
+
+    def get(self, table, pkey):
+        """Return row of the table with given primary key or None."""
+
+        key = (table, pkey)
+
+        try:
+            return self.rows[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable primary key from the user.
+            # Let the database deal with it.
+            return self.load(table, pkey)
+
+        row = self.rows[key] = self.load(table, pkey)
+        return row
+
+    def load(self, table, pkey):
+        """Load row from the database."""
+
+        entity = getattr(self.db, table)
+        info = schema.tables[table]
+
+        if self.prepared and isinstance(info.pkey, basestring):
+            query = text('EXECUTE %s(:pkey)' % get_statement(info))
+            return entity.from_statement(query).params(pkey=pkey).first()
+
+        return entity.get(pkey)
+
+    def column_keys(self, table):
+        """Return names of all columns of the table."""
+
+        # Tables reflected by sparkle.reflect already have them.
+        info = getattr(self.db, table)._table.info
+
+        if 'columns' not in info:
+            info['columns'] = tuple(getattr(self.db, table).c.keys())
+
+        return info['columns']
+
+    def invalidate(self, table, pkey):
+        """Forget cached row after it have been inserted or deleted."""
+
+        try:
+            self.rows.pop((table, pkey), None)
+        except TypeError:
+            pass
+
+
 class DbDict(MutableMapping, dict):
     """
     Special container that inherits MutableMapping for it's
@@ -167,15 +297,17 @@ class Children(DbDict):
     parent entity is passed to Collection instances it produces.
     """
 
-    def __init__(self, db, schema, pkey=None):
+    def __init__(self, db, schema, pkey=None, cache=None):
         """
         :param db:     Reference to the SQLSoup database proxy.
         :param schema: Parent endpoint schema information.
         :param pkey:   Parent primary key value to restrict children.
+        :param cache:  Shared RowCache, new one is created for the root.
         """
         self.db = db
         self.schema = schema
         self.pkey = pkey
+        self.cache = cache if cache is not None else RowCache(db)
 
     def __getitem__(self, key):
         """Retrieve child Collection proxy."""
@@ -183,7 +315,8 @@ class Children(DbDict):
         if key not in self:
             raise KeyError(key)
 
-        return Collection(self.db, self.schema.children[key], self.pkey)
+        return Collection(self.db, self.schema.children[key], self.pkey,
+                          self.cache)
 
     def __contains__(self, key):
         """Determine whether the key is a valid child collection."""
@@ -204,17 +337,19 @@ class Children(DbDict):
 
     def preprocess(self, fragment, uuids, safe):
         for k, v in fragment.iteritems():
-            c = Collection(self.db, self.schema.children[k], self.pkey)
+            c = Collection(self.db, self.schema.children[k], self.pkey,
+                           self.cache)
             c.preprocess(v, uuids, safe)
 
 
 class Collection(DbDict):
     """Multiple entities of a kind restricted to a particular parent."""
 
-    def __init__(self, db, schema, pkey):
+    def __init__(self, db, schema, pkey, cache):
         self.db = db
         self.schema = schema
         self.pkey = pkey
+        self.cache = cache
 
     def __getitem__(self, key):
         """
@@ -223,7 +358,7 @@ class Collection(DbDict):
         """
 
         # Load the child entity for additional checking.
-        child = getattr(self.db, self.schema.table.name).get(key)
+        child = self.cache.get(self.schema.table.name, key)
 
         if child is None:
             raise KeyError(key)
@@ -241,28 +376,86 @@ class Collection(DbDict):
                 raise KeyError(key)
 
         # The entity provably belongs to this parent, return it.
-        return Entity(self.db, self.schema, key)
+        return Entity(self.db, self.schema, key, self.cache)
 
     def __iter__(self):
         """Retrieve child keys restricted to collection parent."""
 
-        # Prepare simple query on this table.
-        query = getattr(self.db, self.schema.table.name)
+        # Use prepared statement when we have one.
+        statement = self.cache.prepared and keys_statement(self.schema)
+
+        if statement:
+            if self.schema.parent.table is None:
+                rows = self.db.execute('EXECUTE %s' % statement)
+            else:
+                rows = self.db.execute('EXECUTE %s(:parent)' % statement,
+                                       params={'parent': self.pkey})
+
+            for row in rows:
+                yield row[0]
+
+            return
+
+        table = getattr(self.db, self.schema.table.name)
+        pkey = self.schema.table.pkey
+
+        # Query just the primary key columns, there is no need to
+        # load complete rows.
+        if isinstance(pkey, basestring):
+            query = table.with_entities(getattr(table, pkey))
+        else:
+            query = table.with_entities(*[getattr(table, k) for k in pkey])
 
         # Apply filters from schema.
-        query.filter_by(**self.schema.filter)
+        query = query.filter_by(**self.schema.filter)
 
         # If we have a parent, relate to it using a foreign key column
         # that is by convention called same as the parent table.
         if self.schema.parent.table is not None:
-            query.filter_by(**{self.schema.table.name: self.pkey})
+            fkey = self.schema.parent.table.name
+            query = query.filter_by(**{fkey: self.pkey})
 
-        # Return primary keys of all queried rows.
-        for row in query.all():
-            yield getattr(row, self.schema.pkey)
+        # Stream primary keys of all matching rows, collections can
+        # be rather large.
+        for row in query.yield_per(ITER_CHUNK):
+            if isinstance(pkey, basestring):
+                yield row[0]
+            else:
+                yield tuple(row)
 
     def add(self, key, value):
-        """Insert new entity to the collection."""
+        """
+        Insert new entity to the collection, including all it's children.
+
+        The whole tree is collected first and then inserted table by
+        table, parents first, with rows of the same table and columns
+        sent to the database in a single batch.
+        """
+
+        rows = []
+        self.collect(key, value, 0, rows)
+
+        # Group rows that can be inserted using a single statement.
+        batches = OrderedDict()
+
+        for depth, name, pkey, desired in rows:
+            batch = (depth, name, frozenset(desired))
+            batches.setdefault(batch, []).append(desired)
+
+        for (depth, name, columns), batch in \
+                sorted(batches.iteritems(), key=lambda item: item[0][0]):
+            table = getattr(self.db, name)._table
+            self.db.session.execute(table.insert(), batch)
+
+        # We might have cached their absence.
+        for depth, name, pkey, desired in rows:
+            self.cache.invalidate(name, pkey)
+
+    def collect(self, key, value, depth, rows):
+        """
+        Validate new entity and append it along with all it's children
+        to the rows as ``(depth, table, pkey, desired)`` tuples.
+        """
 
         desired = dict(value.get('desired', {}))
         pkey = self.schema.table.pkey
@@ -279,13 +472,14 @@ class Collection(DbDict):
             if parent_pkey != self.pkey:
                 raise ValueError('invalid parent')
 
-        getattr(self.db, self.schema.table.name).insert(**desired)
-        self.db.flush()
+        rows.append((depth, self.schema.table.name, key, desired))
 
         # Recurse into children collections.
-        for name, children in value.get('children', {}).iteritems():
-            for k, v in children.iteritems():
-                self[key]['children'][name].add(k, v)
+        children = Children(self.db, self.schema, key, self.cache)
+
+        for name, entities in value.get('children', {}).iteritems():
+            for k, v in entities.iteritems():
+                children[name].collect(k, v, depth + 1, rows)
 
     def __delitem__(self, key):
         """Delete child entity by it's primary key."""
@@ -293,8 +487,10 @@ class Collection(DbDict):
         if key not in self:
             raise KeyError(key)
 
-        self.db.delete(getattr(self.db, self.schema.table.name).get(key))
+        row = self.cache.get(self.schema.table.name, key)
+        self.db.delete(row)
         self.db.flush()
+        self.cache.invalidate(self.schema.table.name, key)
 
     def preprocess(self, fragment, uuids, safe):
         for k, v in fragment.items():
@@ -315,21 +511,22 @@ class Collection(DbDict):
                     del fragment[k]
                     k = nk
 
-            entity = Entity(self.db, self.schema, k)
+            entity = Entity(self.db, self.schema, k, self.cache)
             entity.preprocess(v, uuids, safe)
 
 
 class Entity(DbDict):
     """Container holding both desired state and children."""
 
-    def __init__(self, db, schema, pkey):
+    def __init__(self, db, schema, pkey, cache):
         self.db = db
         self.schema = schema
         self.pkey = pkey
+        self.cache = cache
 
         self.data = {
-            'desired': Desired(db, schema, pkey),
-            'children': Children(db, schema, pkey),
+            'desired': Desired(db, schema, pkey, cache),
+            'children': Children(db, schema, pkey, cache),
         }
 
     def __iter__(self):
@@ -364,41 +561,51 @@ class Desired(DbDict):
     Provides access to columns of the database row.
     """
 
-    def __init__(self, db, schema, pkey):
+    def __init__(self, db, schema, pkey, cache):
         self.db = db
         self.schema = schema
         self.pkey = pkey
+        self.cache = cache
 
     def get_soup_table(self):
         return getattr(self.db, self.schema.table.name)
 
     def get_soup_entity(self):
-        return self.get_soup_table().get(self.pkey)
+        return self.cache.get(self.schema.table.name, self.pkey)
+
+    def get_column_keys(self):
+        return self.cache.column_keys(self.schema.table.name)
 
     def __iter__(self):
         """List database columns with non-null values."""
 
         entity = self.get_soup_entity()
 
-        for key in self.get_soup_table().c.keys():
+        # Entity might have been deleted by another transaction.
+        if entity is None:
+            return
+
+        for key in self.get_column_keys():
             # We treat keys with NULL values as undefined.
             if getattr(entity, key) is not None:
                 yield key
 
     def __contains__(self, key):
-        return key in iter(self)
+        # Only actual columns count, not other attributes of the entity.
+        if key not in self.get_column_keys():
+            return False
+
+        return getattr(self.get_soup_entity(), key, None) is not None
 
     def __getitem__(self, key):
         """Retrieve value of a non-NULL key."""
 
-        value = getattr(self.get_soup_entity(), key, None)
-
-        # When the result is non-None the key still might be something
-        # unexpected such as a builtin method.  So check key validity too.
-        if value is None or key not in self:
+        # The key might be something unexpected such as a builtin method,
+        # so check key validity before looking at the value.
+        if key not in self:
             raise KeyError(key)
 
-        return value
+        return getattr(self.get_soup_entity(), key)
 
     def __delitem__(self, key):
         """
@@ -431,6 +638,10 @@ class Desired(DbDict):
             raise TypeError('immutable field')
 
         entity = self.get_soup_entity()
+
+        if entity is None:
+            raise KeyError(key)
+
         setattr(entity, key, value)
         self.db.flush()
 
@@ -479,7 +690,8 @@ class Desired(DbDict):
                     if k in uuid_pkeys and safe:
                         # Primary keys cannot be created by the user,
                         # but they can be used if the entity already exists.
-                        if self.get_soup_entity() is None:
+                        if not self.cache.exists(self.schema.table.name,
+                                                 self.pkey):
                             raise ValueError('user-defined pkey uuid %r' % (v,))
                 else:
                     try:
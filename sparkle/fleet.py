@@ -0,0 +1,242 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Simulated Twilight Fleet
+
+Peers speaking the Twilight protocol without any real hardware behind
+them, used to put Sparkle under load.  Every peer reports a host with
+some disks and storage pools as it's current state and measures how long
+it takes for desired state changes to reach it.
+"""
+
+__all__ = ['SimulatedTwilight', 'make_desired_state', 'percentile']
+
+from twisted.internet import task, reactor
+from uuid import uuid4
+from time import time
+
+from sparkle.tzmq import Router
+
+
+# Desired state key carrying time of the change for latency measurement.
+STAMP_KEY = 'x-bench'
+
+
+def make_desired_state(hosts, disks, pools):
+    """
+    Generate synthetic desired state for given host uuids.
+
+    Every host gets ``disks`` disks of it's own, all of them in one of
+    ``pools`` storage pools.  Hosts are assigned to pools round-robin,
+    so that every pool is shared by a part of the fleet.
+
+    Returns tuple with list of changes suitable for ``Model.load()``
+    and a mapping of hosts to lists of their storage pools.
+    """
+
+    changes = []
+    layout = {}
+    pool_uuids = [str(uuid4()) for i in xrange(pools)]
+
+    for uuid in pool_uuids:
+        changes.append(('storage_pool', uuid, 'desired', {
+            'uuid': uuid,
+            'type': 'local',
+            'name': uuid[:8],
+        }))
+
+    for i, host in enumerate(hosts):
+        changes.append(('host', host, 'desired', {
+            'uuid': host,
+            'state': 'present',
+        }))
+
+        pool = pool_uuids[i % pools] if pools else None
+        layout[host] = [pool] if pool else []
+
+        for j in xrange(disks):
+            disk = '%s-%i' % (host, j)
+            changes.append(('disk', disk, 'desired', {
+                'id': disk,
+                'size': 1 << 40,
+                'storage_pool': pool,
+            }))
+
+    return changes, layout
+
+
+def percentile(values, p):
+    """Return p-th percentile of the values or None if there are none."""
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class SimulatedTwilight(object):
+    """
+    Peer pretending to be a Twilight running on a host.
+
+    Reports a host with it's disks as current state and follows the
+    incarnation and sequence number protocol for desired state updates,
+    requesting resync whenever it detects a gap.  Only gaps that break
+    an established sync are counted, updates sent before the first full
+    state arrives are expected to miss.
+    """
+
+    def __init__(self, endpoint, uuid, disks, storage_pools):
+        # Identification of the host we simulate.
+        self.uuid = uuid
+        self.disks = ['%s-%i' % (uuid, i) for i in xrange(disks)]
+        self.storage_pools = storage_pools
+
+        # Our own communication state.
+        self.local_incarnation = str(uuid4())
+        self.local_sequence = 0
+
+        # Sparkle's communication state.
+        self.remote_incarnation = None
+        self.remote_sequence = 0
+        self.in_sync = False
+
+        # Desired state as sent by Sparkle.
+        self.desired = {}
+
+        # Measurements.
+        self.started = None
+        self.synced = None
+        self.latencies = []
+        self.resyncs = 0
+        self.received = 0
+
+        self.router = Router(default_recipient='sparkle')\
+                        .connect(endpoint)
+        self.router.on_message = self.on_message
+
+        # Current state changes are reported periodically.
+        self.reporter = task.LoopingCall(self.report)
+
+    def start(self, interval=None):
+        """
+        Connect to Sparkle with a full current state and optionally
+        keep reporting changes every ``interval`` seconds.
+        """
+
+        self.started = time()
+        self.send_changes(self.current_state())
+
+        if interval:
+            self.reporter.start(interval, now=False)
+
+    def stop(self):
+        if self.reporter.running:
+            self.reporter.stop()
+
+        self.router.shutdown()
+
+    def current_state(self):
+        """Produce complete current state of the simulated host."""
+
+        changes = [('host', self.uuid, 'current', {
+            'uuid': self.uuid,
+            'status': 'present',
+        })]
+
+        for disk in self.disks:
+            changes.append(('host_disk', (self.uuid, disk), 'current', {
+                'host': self.uuid,
+                'disk': disk,
+                'size': 1 << 40,
+            }))
+
+        for pool in self.storage_pools:
+            changes.append(('host_storage_pool', (self.uuid, pool),
+                            'current', {
+                'host': self.uuid,
+                'storage_pool': pool,
+                'status': 'ready',
+            }))
+
+        return changes
+
+    def report(self):
+        """Report a minor change of a disk."""
+
+        if not self.disks:
+            return
+
+        disk = self.disks[self.local_sequence % len(self.disks)]
+        self.send_changes([('host_disk', (self.uuid, disk), 'current', {
+            'host': self.uuid,
+            'disk': disk,
+            'size': 1 << 40,
+            'seen': time(),
+        })])
+
+    def send_changes(self, changes):
+        self.router.send({
+            'uuid': self.uuid,
+            'event': 'update',
+            'incarnation': self.local_incarnation,
+            'seq': self.local_sequence,
+            'changes': changes,
+        })
+
+        self.local_sequence += 1
+
+    def on_message(self, message, sender):
+        self.received += 1
+        event = message.get('event')
+
+        if event == 'resync':
+            self.local_sequence = 0
+            self.send_changes(self.current_state())
+            return
+
+        if event != 'update':
+            return
+
+        if message['seq'] == 0:
+            self.remote_incarnation = message['incarnation']
+            self.remote_sequence = 1
+            self.in_sync = True
+            self.desired = {}
+            self.apply(message['changes'])
+
+            if self.synced is None:
+                self.synced = time()
+
+            return
+
+        if message['incarnation'] != self.remote_incarnation \
+           or message['seq'] != self.remote_sequence:
+            if self.in_sync:
+                self.resyncs += 1
+                self.in_sync = False
+
+            self.router.send({'uuid': self.uuid, 'event': 'resync'})
+            return
+
+        self.remote_sequence += 1
+        self.apply(message['changes'])
+
+    def apply(self, changes):
+        now = time()
+
+        for name, pkey, state, part in changes:
+            row = (name, tuple(pkey) if isinstance(pkey, list) else pkey)
+
+            if part is None:
+                self.desired.pop(row, None)
+                continue
+
+            self.desired[row] = part
+
+            if STAMP_KEY in part:
+                self.latencies.append(now - part[STAMP_KEY])
+
+
+# vim:set sw=4 ts=4 et:
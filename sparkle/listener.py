@@ -1,45 +1,168 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['DatabaseListener']
+__all__ = ['DatabaseListener', 'decode_notifies']
 
-from select import select
 from simplejson import loads
+from collections import OrderedDict, deque
+from threading import Event, Lock
 
-from psycopg2 import connect
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2 import connect, Error as DatabaseError, OperationalError
+from psycopg2.extensions import POLL_OK, POLL_WRITE
 
 from twisted.internet import task, reactor
-from twisted.internet.defer import Deferred
-from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor
+from twisted.internet.defer import Deferred, succeed, fail, maybeDeferred
+from twisted.internet.threads import deferToThread
+from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor, \
+                                       IWriteDescriptor
+from twisted.python.failure import Failure
 from zope.interface import implements
 
 from sparkle.util import call_sync
 
 
+# Query used to fetch changes of completed transactions in bulk.
+FETCH_QUERY = '''
+    SELECT txid, entity, action, pkey, payload
+      FROM changelog
+     WHERE txid = ANY(%s)
+  ORDER BY id
+'''
+
+# Query used to fetch changes since given transaction after reconnect.
+HISTORY_QUERY = '''
+    SELECT entity, action, pkey, payload
+      FROM changelog
+     WHERE txid >= %s
+  ORDER BY id
+'''
+
+# Query returning the oldest transaction still running.
+XMIN_QUERY = 'SELECT txid_snapshot_xmin(txid_current_snapshot());'
+
+# Delay before another attempt to fetch changes after a failure.
+FETCH_RETRY = 5.0
+
+# Delay before reconnecting after the listener connection was lost.
+RECONNECT_DELAY = 5.0
+
+
+def make_change(entity, action, pkey, payload):
+    """
+    Convert changelog entry to a desired state change for the model.
+    """
+
+    # Row data are usually embedded as a JSON string.
+    if isinstance(payload, basestring):
+        payload = loads(payload)
+
+    if action == 'DELETE':
+        return (entity, payload[pkey], 'desired', None)
+
+    return (entity, payload[pkey], 'desired', payload)
+
+
+def compact(changes):
+    """
+    Reduce changes to just the final version of every row.
+    Rows keep the position of their first change.
+    """
+
+    rows = OrderedDict()
+
+    for change in changes:
+        rows[change[:2]] = change
+
+    return rows.values()
+
+
+def decode_notifies(notifies):
+    """
+    Decode payloads of given notifications in bulk.
+
+    All payloads are parsed in a single pass as one JSON array.  Should
+    any of them turn out to be malformed, they are decoded one by one
+    instead and the bad ones are reported and skipped.
+    """
+
+    payloads = [notify.payload for notify in notifies]
+
+    try:
+        return loads('[' + ','.join(payloads) + ']')
+    except ValueError:
+        pass
+
+    items = []
+
+    for payload in payloads:
+        try:
+            items.append(loads(payload))
+        except ValueError:
+            print 'database listener skipping bad notify %r' % payload
+
+    return items
+
+
 class DatabaseListener(object):
     """
     Listener for watching the changes in the database.
     """
 
-    implements(IReadDescriptor, IFileDescriptor)
+    implements(IReadDescriptor, IWriteDescriptor, IFileDescriptor)
 
-    def __init__(self, conn_string):
+    def __init__(self, conn_string, fetch_changes=False, fetch_size=1000):
         """
         Create connection to db using connection string.
+
+        With ``fetch_changes`` enabled, notifications only announce
+        transactions and their changes are read from the ``changelog``
+        table, ``fetch_size`` rows at a time.  The table is expected to
+        have ``id``, ``txid``, ``entity``, ``action``, ``pkey`` and
+        ``payload`` columns with the same meaning as the notifications.
         """
 
         # Save the connection string.
         self.conn_string = str(conn_string)
 
-        # Place for the future connection instance.
+        # Place for the future asynchronous connection instance.
         self.conn = None
 
+        # Operation in progress on the connection.  Either connecting
+        # or a query, in which case we also have it's cursor.
+        self.pending = None
+        self.cursor = None
+
+        # Queries waiting for their turn.
+        self.queries = deque()
+
+        # Whether we are waiting for the connection to become writable.
+        self.writing = False
+
+        # Whether we are forwarding changes already.
+        self.started = False
+
+        # Bulk fetching of changes from the changelog table.
+        self.fetch_changes = fetch_changes
+        self.fetch_size = fetch_size
+
+        # Separate connection used from a thread to fetch the changes.
+        self.fetch_conn = None
+
+        # Chain of deliveries that keeps transactions in order.
+        self.chain = succeed(None)
+
+        # Oldest transaction that might not have been delivered yet,
+        # known from our own corks.  We resume from here on reconnect.
+        self.horizon = None
+        self.horizons = {}
+
         # Start with empty set of change listeners.
         self.callbacks = set()
 
-        # Start with empty mapping of txid to waiting transactions.
+        # Start with empty mapping of txid to events of waiting
+        # transactions.  Accessed from API threads, hence the lock.
         self.transactions = {}
+        self.lock = Lock()
 
         # Transaction identificator of the last processed change.
         self.txid = None
@@ -47,10 +170,28 @@ class DatabaseListener(object):
         # Accumulated changes from the same transaction.
         self.changes = []
 
+        # Completed transactions waiting to be handed over to callbacks.
+        self.completed = []
+
+        # Counters for monitoring purposes.
+        self.stats = {
+            'transactions': 0,
+            'changes': 0,
+            'compacted': 0,
+            'commits': 0,
+        }
+
         # Looping call that take care of corking changes made by
         # administrators directly in the database.
         self.corker = None
 
+    def on_resync(self):
+        """
+        Called when changes since the last connection cannot be
+        recovered and a full reload is needed.  To be overriden.
+        May return a Deferred to hold further deliveries until done.
+        """
+
     def add_callback(self, callback):
         """Register callback to notify of every transaction's changes."""
         self.callbacks.add(callback)
@@ -61,142 +202,558 @@ class DatabaseListener(object):
 
     def register(self, txid):
         """
-        Register deferred for given transaction id.
+        Register interest in completion of given transaction id.
+        Safe to call from any thread.
         """
 
-        if txid in self.transactions:
-            raise KeyError('someone is already waiting for txid %i' % txid)
+        with self.lock:
+            if txid in self.transactions:
+                raise KeyError('someone is already waiting for txid %i' % txid)
 
-        self.transactions[txid] = Deferred()
+            self.transactions[txid] = Event()
 
     def abort(self, txid):
         """
         Stop waiting for given transaction id.
+        Safe to call from any thread.
         """
 
-        if txid not in self.transactions:
-            raise KeyError('no-one is waiting for txid %i' % txid)
+        with self.lock:
+            if txid not in self.transactions:
+                raise KeyError('no-one is waiting for txid %i' % txid)
+
+            self.transactions.pop(txid)
+
+    def wait(self, txid, timeout=None):
+        """
+        Block until the transaction completes or ``timeout`` seconds pass.
+        Returns whether it have completed.  Never call from the reactor.
+        """
 
-        self.transactions.pop(txid)
+        with self.lock:
+            event = self.transactions[txid]
 
-    def wait(self, txid):
-        """Produce deferred that will wait until the transaction completes."""
-        return self.transactions[txid]
+        return event.wait(timeout)
 
     def connect(self):
         """
-        Connect to database and start receiving changes.
+        Connect to database and start listening for changes.
+
+        The connection runs in asynchronous mode driven by the reactor,
+        so nothing here blocks.  Returns a Deferred that fires once we
+        are listening.
         """
 
         print 'database listener connecting'
 
-        self.conn = connect(self.conn_string)
-        self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        # Drop any previous connection.
+        self.disconnect()
+
+        try:
+            self.conn = connect(self.conn_string, async_=True)
+        except DatabaseError:
+            return fail()
+
+        self.pending = d = Deferred()
+        reactor.addReader(self)
+        self.poll()
+
+        def listen(ignored):
+            return self.execute('LISTEN changelog;')
+
+        def connected(ignored):
+            print 'database listener connected successfully'
+
+        d.addCallback(listen)
+        d.addCallback(connected)
+        return d
+
+    def disconnect(self, reason=None):
+        """
+        Close the connection and fail all operations in progress.
+        """
+
+        if self.conn is None:
+            return
+
+        reactor.removeReader(self)
+        reactor.removeWriter(self)
+        self.writing = False
+
+        if not self.conn.closed:
+            self.conn.close()
+
+        self.conn = None
+
+        if reason is None:
+            reason = Failure(OperationalError('listener disconnected'))
+
+        pending, queries = self.pending, self.queries
+        self.pending = self.cursor = None
+        self.queries = deque()
+
+        if pending is not None:
+            pending.errback(reason)
+
+        for sql, args, d in queries:
+            d.errback(reason)
+
+    def lost(self, reason):
+        """
+        Handle loss of the connection by reconnecting later.
+        """
+
+        print 'database listener connection lost: %s' \
+                    % reason.getErrorMessage()
+
+        self.disconnect(reason)
+
+        # Partially received transaction will be recovered as well.
+        self.txid = None
+        self.changes = []
+        self.horizons.clear()
+
+        if self.started:
+            reactor.callLater(RECONNECT_DELAY, self.reconnect)
+
+    def reconnect(self):
+        """
+        Attempt to connect again, keep trying until it succeeds.
+        """
+
+        if not self.started or self.conn is not None:
+            return
+
+        def failure(fail):
+            print 'database listener reconnect failed, retrying in %i ' \
+                  'seconds' % RECONNECT_DELAY
+            reactor.callLater(RECONNECT_DELAY, self.reconnect)
+
+        d = self.connect()
+        d.addCallbacks(lambda ignored: self.enqueue(self.resume), failure)
+
+    def resume(self):
+        """
+        Recover changes we might have missed while disconnected.
+        Falls back to a full reload when they are not available.
+
+        Every transaction older than the oldest one running now is
+        recovered either way, so threads waiting for any of them are
+        released afterwards.
+        """
+
+        def recover(rows):
+            xmin = int(rows[0][0])
+
+            if not self.fetch_changes or self.horizon is None:
+                print 'database listener history not available, reloading'
+                d = maybeDeferred(self.on_resync)
+            else:
+                d = deferToThread(self.load_history, self.horizon)
+                d.addCallbacks(success, failure)
+
+            d.addCallback(lambda ignored: self.caught_up(xmin))
+            return d
+
+        def success(changes):
+            if changes is None:
+                print 'database listener history pruned, reloading'
+                return self.on_resync()
+
+            print 'database listener resumed with %i changes' % len(changes)
+            self.deliver([(None, changes)])
+
+        def failure(reason):
+            print 'database listener resume failed, reloading: %s' \
+                        % reason.getErrorMessage()
+            return self.on_resync()
+
+        d = self.execute(XMIN_QUERY)
+        d.addCallback(recover)
+        return d
+
+    def caught_up(self, xmin):
+        """
+        Note that all transactions older than ``xmin`` are in the model
+        and release threads waiting for any of them.
+        """
+
+        if self.horizon is None or self.horizon < xmin:
+            self.horizon = xmin
 
-        with self.conn.cursor() as curs:
-            curs.execute("LISTEN changelog;")
+        with self.lock:
+            for txid, event in self.transactions.iteritems():
+                if txid < xmin:
+                    event.set()
 
-        print 'database listener connected successfully'
+    def execute(self, sql, args=None):
+        """
+        Queue query for execution on the listener connection.
+        Returns a Deferred with the resulting rows.
+        """
+
+        if self.conn is None:
+            return fail(OperationalError('listener not connected'))
+
+        d = Deferred()
+        self.queries.append((sql, args, d))
+        self.next_query()
+        return d
+
+    def next_query(self):
+        """
+        Start the next queued query if the connection is idle.
+        """
+
+        if self.pending is not None or not self.queries:
+            return
+
+        sql, args, self.pending = self.queries.popleft()
+        self.cursor = self.conn.cursor()
+
+        try:
+            self.cursor.execute(sql, args)
+        except DatabaseError:
+            return self.complete(Failure())
+
+        self.poll()
+
+    def complete(self, reason=None):
+        """
+        Finish the operation in progress and start the next one.
+        """
+
+        d, curs = self.pending, self.cursor
+        self.pending = self.cursor = None
+
+        if reason is not None:
+            d.errback(reason)
+        elif curs is not None and curs.description is not None:
+            d.callback(curs.fetchall())
+        else:
+            d.callback(None)
+
+        if self.conn is not None:
+            self.next_query()
+
+    def poll(self):
+        """
+        Let the connection make progress and watch for what it needs.
+        """
+
+        try:
+            state = self.conn.poll()
+        except DatabaseError:
+            reason = Failure()
+
+            if self.conn.closed:
+                return self.lost(reason)
+
+            if self.pending is not None:
+                self.complete(reason)
+
+            return
+
+        if state == POLL_OK:
+            if self.pending is not None:
+                self.complete()
+
+        if state == POLL_WRITE and not self.writing:
+            reactor.addWriter(self)
+            self.writing = True
+
+        elif state != POLL_WRITE and self.writing:
+            reactor.removeWriter(self)
+            self.writing = False
 
     def fileno(self):
+        if self.conn is None:
+            return -1
+
         return self.conn.fileno()
 
     def shutdown(self):
         print 'shutting down database listener'
-        reactor.removeReader(self)
-        self.conn.close()
-        self.conn = None
+        self.started = False
+        self.disconnect()
+
+        if self.fetch_conn is not None:
+            self.fetch_conn.close()
+            self.fetch_conn = None
+
         self.corker.stop()
         self.corker = None
 
     def connectionLost(self, reason):
-        pass
+        if self.conn is not None:
+            self.lost(reason)
 
     def start(self):
         """
         Start forwarding changes to registered handlers.
         """
 
-        # Start receiving descriptor events.
-        reactor.addReader(self)
+        self.started = True
+
+        # Process whatever have arrived while we were loading,
+        # unless the connection have been lost in the meantime.
+        if self.conn is None:
+            self.reconnect()
+        else:
+            self.receive()
 
         # Start periodic corking of changes made in the database
         # manually by administrators.
-        self.corker = task.LoopingCall(self.cork)
+        self.corker = task.LoopingCall(self.periodic_cork)
         self.corker.start(5.0)
 
     def cork(self):
         """
         Insert read barrier to the queue of pending changes.
-        Return transaction identificator.
+        Returns Deferred transaction identificator.
+
+        Every transaction older than the oldest one running at the time
+        of the cork will have been delivered once the cork arrives.
+        We remember that as a point to resume from after reconnect.
         """
 
-        with self.conn.cursor() as curs:
-            curs.execute('SELECT cork() AS cork;')
-            return int(curs.fetchone()[0])
+        def corked(rows):
+            txid, xmin = int(rows[0][0]), int(rows[0][1])
+            self.horizons[txid] = xmin
+            return txid
 
-    def flush(self):
+        d = self.execute('SELECT cork(), '
+                         'txid_snapshot_xmin(txid_current_snapshot());')
+        d.addCallback(corked)
+        return d
+
+    def periodic_cork(self):
         """
-        Flush transaction changes to callbacks.
+        Cork the changes, only reporting failures.
         """
 
-        # Unblock any waiting threads.
-        if self.txid in self.transactions:
-            self.transactions[self.txid].callback(self.txid)
+        def failure(fail):
+            print 'database listener cork failed: %s' \
+                        % fail.getErrorMessage()
 
-        # Notify listeners about new completed transaction.
-        for callback in self.callbacks:
-            reactor.callLater(0, callback, self.changes)
+        return self.cork().addErrback(failure)
+
+    def flush(self):
+        """
+        Mark accumulated changes as a completed transaction.
+        """
+
+        self.completed.append((self.txid, self.changes))
 
         # Reset accumulated changes and transaction id.
         self.changes = []
         self.txid = None
 
+    def deliver(self, completed):
+        """
+        Hand completed transactions over to callbacks.
+
+        Consecutive transactions are merged and compacted, so that a
+        backlog of them ends up as a single commit with just the final
+        version of every row.
+        """
+
+        changes = [change for txid, part in completed for change in part]
+        compacted = compact(changes)
+
+        self.stats['transactions'] += len(completed)
+        self.stats['changes'] += len(changes)
+        self.stats['compacted'] += len(changes) - len(compacted)
+
+        # Notify listeners about the new changes.
+        if compacted:
+            self.stats['commits'] += 1
+
+            for callback in self.callbacks:
+                callback(compacted)
+
+        # Advance the point to resume from.
+        for txid, part in completed:
+            if txid in self.horizons:
+                self.horizon = self.horizons.pop(txid)
+
+        # Unblock any waiting threads now that the changes are
+        # in the model.
+        with self.lock:
+            for txid, part in completed:
+                if txid in self.transactions:
+                    self.transactions[txid].set()
+
     def doRead(self):
+        """
+        Let the connection process incoming data.
+        """
+
+        self.poll()
+
+        if self.started and self.conn is not None:
+            self.receive()
+
+    def doWrite(self):
+        """
+        Let the connection send out outgoing data.
+        """
+
+        self.poll()
+
+    def receive(self):
         """
         Receive fresh changes from the database.
+
+        Whole queue of notifications is drained at once, decoded in bulk
+        and the completed transactions are delivered together.
         """
 
-        self.conn.poll()
+        if self.conn is None or not self.conn.notifies:
+            return
 
-        if len(self.conn.notifies) > 0:
-            # There are some pending notifications, plan one more poll
-            # right after we process this one just to make sure we have
-            # consumed all the events.
-            reactor.callLater(0, self.doRead)
+        # Take over all the pending notifications.
+        notifies = self.conn.notifies[:]
+        del self.conn.notifies[:]
+
+        for item in decode_notifies(notifies):
+            self.ingest(item)
+
+        if self.completed:
+            completed, self.completed = self.completed, []
+
+            if self.fetch_changes:
+                self.enqueue(self.fetch, completed)
+            else:
+                self.enqueue(self.deliver, completed)
+
+    def enqueue(self, fn, *args):
+        """
+        Run function once everything enqueued before it is done.
+        Functions may return Deferreds to hold the queue.
+        """
+
+        def run(ignored):
+            return fn(*args)
+
+        def report(reason):
+            reason.printTraceback()
+
+        self.chain.addCallback(run)
+        self.chain.addErrback(report)
+
+    def fetch(self, completed):
+        """
+        Fetch changes of completed transactions and deliver them.
+        Retries until it succeeds so that no transaction is skipped.
+        """
 
-        while len(self.conn.notifies) > 0:
-            # Pop one notification off the queue.
-            item = loads(self.conn.notifies.pop(0).payload)
+        def failure(fail):
+            print 'database listener fetch failed, retrying in %i ' \
+                  'seconds: %s' % (FETCH_RETRY, fail.getErrorMessage())
+            return task.deferLater(reactor, FETCH_RETRY,
+                                   self.fetch, completed)
 
-            # Parse first two arguments - type of operation and transaction.
-            op = item[0]
-            txid = int(item[1])
+        d = deferToThread(self.load_changes, completed)
+        d.addCallbacks(self.deliver, failure)
+        return d
+
+    def fetch_connection(self):
+        """
+        Return connection for fetching changes, connecting if needed.
+        """
+
+        if self.fetch_conn is None or self.fetch_conn.closed:
+            self.fetch_conn = connect(self.conn_string)
+
+        return self.fetch_conn
+
+    def load_changes(self, completed):
+        """
+        Read changes of given transactions from the changelog table.
+        Runs in a thread, returns transactions with all their changes.
+        """
+
+        conn = self.fetch_connection()
+        txids = [txid for txid, changes in completed]
+        found = {}
+
+        try:
+            # Use server-side cursor so that huge transactions
+            # do not have to fit in memory twice.
+            with conn.cursor('changelog') as curs:
+                curs.itersize = self.fetch_size
+                curs.execute(FETCH_QUERY, (txids,))
+
+                for txid, entity, action, pkey, payload in curs:
+                    change = make_change(entity, action, pkey, payload)
+                    found.setdefault(txid, []).append(change)
+        finally:
+            conn.rollback()
+
+        return [(txid, changes + found.pop(txid, []))
+                for txid, changes in completed]
+
+    def ingest(self, item):
+        """
+        Process single decoded notification.
+        """
+
+        # Parse first two arguments - type of operation and transaction.
+        op = item[0]
+        txid = int(item[1])
+
+        if self.txid is None:
+            # First transaction should not trigger a flush.
+            self.txid = txid
+
+        if self.txid != txid:
+            # Flush on txid change.
+            self.flush()
+            self.txid = txid
+
+        if op == 'u':
+            # Accumulate changes.
+            entity, action, pkey = item[2:5]
+            self.changes.append(make_change(entity, action, pkey, item[-1]))
+
+        elif op == 't':
+            # Changes of the transaction are in the changelog table,
+            # we will fetch them once it completes.
+            pass
+
+        elif op == 'cork':
+            # Flush on every cork operation.
+            self.flush()
+
+    def load_history(self, horizon):
+        """
+        Read changes of all transactions since ``horizon`` from the
+        changelog table.  Runs in a thread, returns None when some of
+        them might have been pruned already.
+        """
 
-            if self.txid is None:
-                # First transaction should not trigger a flush.
-                self.txid = txid
+        conn = self.fetch_connection()
+        changes = []
 
-            if self.txid != txid:
-                # Flush on txid change.
-                self.flush()
-                self.txid = txid
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT min(txid) FROM changelog;')
+                oldest = curs.fetchone()[0]
 
-            if op == 'u':
-                # Accumulate changes.
-                entity, action, pkey = item[2:5]
-                payload = loads(item[-1])
+            if oldest is None or oldest > horizon:
+                return None
 
-                if action == 'DELETE':
-                    change = (entity, payload[pkey], 'desired', None)
-                else:
-                    change = (entity, payload[pkey], 'desired', payload)
+            with conn.cursor('changelog') as curs:
+                curs.itersize = self.fetch_size
+                curs.execute(HISTORY_QUERY, (horizon,))
 
-                self.changes.append(change)
+                for entity, action, pkey, payload in curs:
+                    changes.append(make_change(entity, action, pkey, payload))
+        finally:
+            conn.rollback()
 
-            elif op == 'cork':
-                # Flush on every cork operation.
-                self.flush()
+        return changes
 
     def logPrefix(self):
         return 'listener'
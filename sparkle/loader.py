@@ -0,0 +1,163 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Parallel Model Loader
+
+Reads desired state of all tables from the database to be loaded into
+the model.  Every table is read over it's own connection, all of them
+sharing a single exported snapshot so that the result is consistent.
+Rows are streamed from server-side cursors in chunks and indexed as
+they arrive, so that no intermediate copies of the data are made.
+"""
+
+__all__ = ['ModelLoader', 'retained_query']
+
+from psycopg2 import connect
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ, \
+                                 UNICODE, UNICODEARRAY, register_type
+
+from twisted.internet.defer import DeferredList, DeferredSemaphore
+from twisted.internet.threads import deferToThread
+
+from sparkle.schema import schema
+from sparkle.model import IndexedMapping
+
+
+def retained_query(table, columns='*'):
+    """
+    Produce query for rows of the table that belong to the model,
+    taking retention policy of the table into account.
+    """
+
+    query = 'SELECT %s FROM "%s"' % (columns, table.name)
+    retain = table.retain
+
+    if retain is None:
+        return query
+
+    if 'hours' in retain:
+        query += ' WHERE "%s" >= now() - interval \'%i hours\'' \
+                    % (retain['column'], retain['hours'])
+
+    if 'rows' in retain:
+        query += ' ORDER BY "%s" DESC LIMIT %i' \
+                    % (retain['column'], retain['rows'])
+
+    return query
+
+
+class ModelLoader(object):
+    """
+    Loads desired state of all non-virtual tables in parallel.
+    """
+
+    def __init__(self, conn_string, workers=4, chunk_size=1000):
+        # Where to read data from.
+        self.conn_string = str(conn_string)
+
+        # How many tables to read at once.
+        self.workers = workers
+
+        # Number of rows to transfer at once.
+        self.chunk_size = chunk_size
+
+    def load(self):
+        """
+        Read all tables.  Returns Deferred mapping of table names
+        to indexed mappings with their rows.
+        """
+
+        names = [name for name, table in schema.tables.iteritems()
+                 if not table.virtual]
+
+        semaphore = DeferredSemaphore(self.workers)
+
+        def export(result):
+            conn, snapshot = result
+            ds = [semaphore.run(deferToThread, self.load_table,
+                                name, snapshot)
+                  for name in names]
+
+            d = DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+            d.addBoth(finish, conn)
+            return d
+
+        def finish(result, conn):
+            # Worker connections have imported the snapshot by now,
+            # we no longer need to keep it.
+            conn.close()
+
+            if isinstance(result, list):
+                return dict(zip(names, [value for ok, value in result]))
+
+            # Unwrap the first failure.
+            return result.value.subFailure
+
+        d = deferToThread(self.export_snapshot)
+        d.addCallback(export)
+        return d
+
+    def open(self):
+        """Open read-only connection with a stable snapshot."""
+
+        conn = connect(self.conn_string)
+
+        # Return text as unicode, just like the SQLAlchemy engine.
+        register_type(UNICODE, conn)
+        register_type(UNICODEARRAY, conn)
+
+        conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ,
+                         readonly=True)
+        return conn
+
+    def export_snapshot(self):
+        """
+        Open transaction and export it's snapshot for the workers.
+        Runs in a thread, returns the connection and snapshot id.
+        """
+
+        conn = self.open()
+
+        with conn.cursor() as curs:
+            curs.execute('SELECT pg_export_snapshot();')
+            return conn, curs.fetchone()[0]
+
+    def load_table(self, name, snapshot):
+        """
+        Read all rows of a table.  Runs in a thread.
+        """
+
+        table = schema.tables[name]
+        rows = IndexedMapping(table.index)
+        conn = self.open()
+
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SET TRANSACTION SNAPSHOT %s;', (snapshot,))
+
+            with conn.cursor(name) as curs:
+                curs.itersize = self.chunk_size
+                curs.execute(retained_query(table))
+
+                columns = None
+
+                while True:
+                    chunk = curs.fetchmany(self.chunk_size)
+
+                    if not chunk:
+                        break
+
+                    if columns is None:
+                        columns = [c[0] for c in curs.description]
+
+                    parts = [dict(zip(columns, row)) for row in chunk]
+                    rows.bulk_load([(table.primary_key(part), part)
+                                    for part in parts])
+        finally:
+            conn.close()
+
+        return rows
+
+
+# vim:set sw=4 ts=4 et:
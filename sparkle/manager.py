@@ -12,6 +12,12 @@ from sparkle.schema import schema
 from sparkle.listener import DatabaseListener
 from sparkle.twilight import Twilight
 from sparkle.placement import Placement
+from sparkle.reconcile import Reconciler
+from sparkle.loader import ModelLoader, retained_query
+
+
+# Seconds between pruning of tables with a retention policy.
+PRUNE_INTERVAL = 60.0
 
 
 class Manager(object):
@@ -19,16 +25,46 @@ class Manager(object):
     The main application logic of Sparkle.
     """
 
-    def __init__(self, router, db, notifier, apikey):
+    def __init__(self, router, db, notifier, apikey,
+                 max_queue_messages=None, max_queue_bytes=None,
+                 fetch_changes=False, reconcile_interval=None,
+                 load_workers=4, prepared_statements=False):
         """
         Stores the event sinks for later use.
+
+        Messages for hosts that do not keep up are queued, up to
+        ``max_queue_messages`` and ``max_queue_bytes`` per host.
+
+        With ``fetch_changes`` database changes are read from the
+        changelog table instead of the notifications themselves.
+
+        With ``reconcile_interval`` the model is continuously compared
+        with the database, one table every that many seconds.
+
+        Up to ``load_workers`` tables are read at once during load.
+
+        With ``prepared_statements`` the API uses statements prepared
+        by the database connections, see ``sparkle.pool``.
         """
         self.db = db
+        self.prepared_statements = prepared_statements
         self.router = router
 
         # API secret key.
         self.apikey = apikey
 
+        # Limits of outgoing queues for individual hosts.
+        self.max_queue_messages = max_queue_messages
+        self.max_queue_bytes = max_queue_bytes
+
+        # Transactions of API writes that conflicted with others,
+        # including numbers of conflicts per affected table.
+        self.write_stats = {
+            'retries': 0,
+            'conflicts': 0,
+            'tables': {},
+        }
+
         # This is where we keep the configuration and status data.
         self.model = Model()
 
@@ -37,8 +73,26 @@ class Manager(object):
         self.overlay = OverlayModel(self.model)
 
         # Create listener for applying changes in database.
-        self.listener = DatabaseListener(self.db.engine.url)
-        self.listener.add_callback(self.apply_changes)
+        # Without database (e.g. in benchmarks) the model is fed directly.
+        if self.db is not None:
+            self.listener = DatabaseListener(self.db.engine.url,
+                                             fetch_changes=fetch_changes)
+            self.listener.add_callback(self.apply_changes)
+            self.listener.on_resync = self.reload
+
+            # Loader reading the whole desired state in parallel.
+            self.loader = ModelLoader(self.db.engine.url, load_workers)
+        else:
+            self.listener = None
+
+        # Periodic pruning of rows out of their tables' retention window.
+        self.pruner = task.LoopingCall(self.prune)
+
+        # Background check for drift between the model and database.
+        if self.db is not None and reconcile_interval:
+            self.reconciler = Reconciler(self, reconcile_interval)
+        else:
+            self.reconciler = None
 
         # This is how we notify users via websockets
         self.notifier = notifier
@@ -77,29 +131,10 @@ class Manager(object):
 
         print 'scheduling data load'
 
-        def load():
-            # Drop any cached changes.
-            self.db.rollback()
-
-            # Attempt to connect database change listener so that we
-            # don't miss out on any notifications.
-            self.listener.connect()
-
-            # Stash for the extracted data.
-            data = []
-
-            for name, table in schema.tables.iteritems():
-                if not table.virtual:
-                    for row in getattr(self.db, name).all():
-                        part = {c.name: getattr(row, c.name) for c in row.c}
-                        pkey = table.primary_key(part)
-                        data.append((name, pkey, 'desired', part))
-
-            # Return complete data set to be loaded into the model.
-            return data
-
-        # Attempt the load the data.
-        d = deferToThread(load)
+        # Attempt to connect database change listener first so that we
+        # don't miss out on any notifications, then load the data.
+        d = self.listener.connect()
+        d.addCallback(lambda ignored: self.loader.load())
 
         # Load failure handler traps just the OperationalError from
         # database, other exceptions need to be propagated so that we
@@ -109,10 +144,9 @@ class Manager(object):
             reactor.callLater(15, self.schedule_load)
 
         # In case of success
-        def success(data):
+        def success(tables):
             print 'data successfully loaded'
-            self.overlay.load(data)
-            self.overlay.commit()
+            self.replace_desired(tables)
 
             # Start send out the database changes to the clients.
             self.notifier.set_model(self.overlay)
@@ -121,9 +155,106 @@ class Manager(object):
             # Start processing database changes.
             self.listener.start()
 
+            # Start looking for any drift from now on.
+            if self.reconciler is not None:
+                self.reconciler.start()
+
+            # Keep tables with retention policy in check.
+            self.pruner.start(PRUNE_INTERVAL, now=False)
+
         # Configure where to go from there.
         d.addCallbacks(success, failure)
 
+    def reload(self):
+        """
+        Replace desired state with a fresh copy from the database.
+        Used when the listener cannot tell what changes it has missed.
+        Retries every 15 seconds until it succeeds.
+        """
+
+        print 'reloading data'
+
+        def success(tables):
+            self.replace_desired(tables)
+            print 'data successfully reloaded'
+
+        # Keep trying, the listener holds further deliveries and
+        # waiting writers until we are done.
+        def failure(fail):
+            print 'data reload failed, retrying in 15 seconds: %s' \
+                        % fail.getErrorMessage()
+            return task.deferLater(reactor, 15, self.reload)
+
+        d = self.loader.load()
+        d.addCallbacks(success, failure)
+        return d
+
+    def replace_desired(self, tables):
+        """
+        Make desired state match freshly loaded tables in a single
+        commit, removing rows that are no longer present.
+        """
+
+        for name, rows in tables.iteritems():
+            stale = [pkey for pkey in self.model.desired[name]
+                     if pkey not in rows]
+
+            self.overlay.desired[name].bulk_load(rows)
+
+            for pkey in stale:
+                del self.overlay.desired[name][pkey]
+
+        self.overlay.commit()
+
+    def prune(self):
+        """
+        Drop rows of tables with a retention policy that have fallen out
+        of their window.  The window is determined by the database.
+
+        Rows are only forgotten by the model and not actually deleted,
+        so they are removed directly and nobody gets notified.
+        """
+
+        tables = {name: set(self.model.desired[name])
+                  for name, table in schema.tables.iteritems()
+                  if table.retain and not table.virtual}
+
+        def load():
+            keep = {}
+
+            try:
+                for name in tables:
+                    table = schema.tables[name]
+
+                    if isinstance(table.pkey, basestring):
+                        columns = '"%s"' % table.pkey
+                    else:
+                        columns = ', '.join('"%s"' % k for k in table.pkey)
+
+                    query = retained_query(table, columns)
+                    keep[name] = set(table.primary_key(dict(row))
+                                     for row in self.db.execute(query))
+            finally:
+                self.db.rollback()
+
+            return keep
+
+        # Rows that appeared while we were asking stay untouched.
+        def success(keep):
+            for name, keys in tables.iteritems():
+                stale = keys.difference(keep[name])
+                self.model.desired[name].bulk_apply({}, stale)
+
+                if stale:
+                    print 'pruned %i rows of %r' % (len(stale), name)
+
+        def failure(reason):
+            print 'pruning failed: %s' % reason.getErrorMessage()
+
+        d = deferToThread(load)
+        d.addCallbacks(success, failure)
+        return d
+
     def apply_changes(self, changes):
         """Incorporate changes from database into the model."""
         self.overlay.load(changes)
@@ -159,7 +290,7 @@ class Manager(object):
 
         # Create set of changed rows for faster lookup below when we
         # decide whether to send them out or not.
-        modified = set(tuple(row[:2]) for row in rows)
+        modified = set((new.table.name, new.pkey) for old, new in rows)
 
         # Repair placement for all those rows using their new version in
         # the model.
@@ -174,9 +305,91 @@ class Manager(object):
                 for host in row_hosts:
                     self.hosts[host].on_row_changed(name, pkey)
 
-        # Flush the affected hosts.
+        # Queue changes for the affected hosts.
+        for host in hosts:
+            self.hosts[host].send_pending_changes(flush=False)
+
+        # And flush them all at once.
+        self.flush_hosts([self.hosts[host] for host in hosts])
+
+    def flush_hosts(self, hosts):
+        """
+        Pass messages queued for given hosts to the router in one batch.
+        """
+
+        batch = []
+
+        for host in hosts:
+            batch.extend((message, host.peer) for message in host.outbox)
+
+        results = self.router.send_many(batch)
+        offset = 0
+
         for host in hosts:
-            self.hosts[host].send_pending_changes()
+            count = len(host.outbox)
+            host.delivered(results[offset:offset + count])
+            offset += count
+
+    def on_writable(self):
+        """
+        Called by router when it can accept messages again.
+        Flushes all hosts with queued messages.
+        """
+
+        self.flush_hosts([host for host in self.hosts.itervalues()
+                          if host.outbox])
+
+    def get_stats(self):
+        """
+        Called from API to obtain runtime statistics.
+        """
+
+        hosts = {}
+
+        for uuid, host in self.hosts.iteritems():
+            hosts[uuid] = {
+                'queued': len(host.outbox),
+                'bytes': host.outbox.bytes,
+                'dropped': host.outbox.dropped,
+            }
+
+        stats = {
+            'hosts': hosts,
+            'router': dict(self.router.stats),
+        }
+
+        if self.listener is not None:
+            stats['listener'] = dict(self.listener.stats)
+
+        if self.reconciler is not None:
+            stats['reconciler'] = dict(self.reconciler.stats)
+
+        stats['writes'] = {
+            'retries': self.write_stats['retries'],
+            'conflicts': self.write_stats['conflicts'],
+            'tables': dict(self.write_stats['tables']),
+        }
+
+        if self.db is not None and hasattr(self.db.engine.pool, 'get_stats'):
+            stats['pool'] = self.db.engine.pool.get_stats()
+
+        return stats
+
+    def record_write_conflict(self, tables, exhausted):
+        """
+        Called from API when a transaction touching given tables
+        conflicted with another one.  With ``exhausted`` it have not
+        been retried any more.
+        """
+
+        if exhausted:
+            self.write_stats['conflicts'] += 1
+        else:
+            self.write_stats['retries'] += 1
+
+        for name in tables:
+            self.write_stats['tables'][name] = \
+                    self.write_stats['tables'].get(name, 0) + 1
 
     def update_placement(self, hosts, name, pkey):
         """
@@ -255,6 +468,47 @@ class Manager(object):
                 if key not in keys:
                     return {row.get(key): row.to_dict() for row in rows}
 
+    def list_history(self, path, keys, before, limit):
+        """
+        Called from API to page through history of a table with a
+        retention policy straight from the database, newest first.
+        Runs in the calling thread.
+
+        Takes a ``datetime`` to list rows older than and a validated
+        number of rows to return.
+        """
+
+        endpoint = schema.resolve_path(path)
+        table = endpoint.table
+
+        # Filter using the endpoint filter and parent relationship.
+        filter = dict(endpoint.filter)
+
+        if endpoint.parent.table is not None:
+            pname = endpoint.parent.table.name
+            filter[pname] = keys[pname]
+
+        entity = getattr(self.db, table.name)
+        column = getattr(entity, table.retain['column'])
+
+        try:
+            rows = entity.filter_by(**filter) \
+                         .filter(column < before) \
+                         .order_by(column.desc()) \
+                         .limit(limit) \
+                         .all()
+
+            result = {}
+
+            for row in rows:
+                part = {c.name: getattr(row, c.name) for c in row.c}
+                result[table.primary_key(part)] = {'desired': part}
+
+            return result
+
+        finally:
+            self.db.rollback()
+
     def list_collection_join(self, path, keys):
         """
         Called from API to obtain list of collection items details.
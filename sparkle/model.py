@@ -534,6 +534,25 @@ class OverlayMapping(MutableMapping):
     def filter(self, **fields):
         return {k: self[k] for k in self.kwlookup(**fields)}
 
+    def bulk_load(self, rows):
+        """
+        Stage many rows at once.
+
+        Accepts either ``(key, value)`` pairs or a whole IndexedMapping,
+        which is adopted as it is when there is nothing staged yet.
+        """
+
+        if isinstance(rows, IndexedMapping) and not self.overlay \
+           and set(rows.idx) == set(self.parent.idx):
+            self.overlay = rows
+        else:
+            if not isinstance(rows, Mapping):
+                rows = dict(rows)
+
+            self.overlay.bulk_load(rows.iteritems())
+
+        self.deleted.update(key for key in rows if key in self.parent)
+
     def rollback(self):
         """
         Discard the overlay data and reset to the underlying mapping state.
@@ -547,11 +566,8 @@ class OverlayMapping(MutableMapping):
         Apply all changes in the overlay to the underlying mapping.
         """
 
-        for key in self.deleted:
-            if key not in self.overlay:
-                del self.parent[key]
-
-        self.parent.update(self.overlay)
+        deletes = [key for key in self.deleted if key not in self.overlay]
+        self.parent.bulk_apply(self.overlay, deletes)
         self.rollback()
 
 
@@ -600,6 +616,64 @@ class IndexedMapping(MutableMapping):
         self.unindex(key)
         del self.data[key]
 
+    def bulk_load(self, rows):
+        """
+        Insert many ``(key, value)`` pairs at once.
+        Existing keys are replaced.
+        """
+
+        self.bulk_apply(dict(rows))
+
+    def bulk_apply(self, upserts, deletes=()):
+        """
+        Apply many changes at once.
+
+        Takes a mapping of keys to their new values and an iterable of
+        keys to remove.  Values are not checked and indexes are patched
+        in one pass over the changes per index.  Keys both upserted and
+        deleted end up with their upserted values.
+
+        An IndexedMapping applied to an empty one with the same indexes
+        is taken over as it is and must not be modified afterwards.
+        """
+
+        if not self.data and isinstance(upserts, IndexedMapping) \
+           and set(upserts.idx) == set(self.idx):
+            self.data = upserts.data
+            self.idx = upserts.idx
+            return
+
+        if isinstance(upserts, IndexedMapping):
+            upserts = upserts.data
+
+        data = self.data
+        removed = [key for key in set(deletes)
+                   if key in data and key not in upserts]
+        replaced = [key for key in upserts if key in data]
+
+        # Drop old values from the indexes.
+        for i, index in self.idx.iteritems():
+            for key in removed + replaced:
+                value = data[key]
+
+                if i in value:
+                    keys = index[value[i]]
+                    keys.discard(key)
+
+                    if not keys:
+                        del index[value[i]]
+
+        for key in removed:
+            del data[key]
+
+        data.update(upserts)
+
+        # Index the new values.
+        for i, index in self.idx.iteritems():
+            for key, value in upserts.iteritems():
+                if i in value:
+                    index.setdefault(value[i], set()).add(key)
+
     def __contains__(self, key):
         return key in self.data
 
@@ -19,12 +19,25 @@ __all__ = ['Pointer', 'normalize_path']
 
 
 from sparkle.common import *
-from sparkle.util import remove_nulls
+from sparkle.util import remove_nulls, is_serialization_failure
 
 from collections import Iterable, Mapping, MutableMapping
 from sqlalchemy.exc import DatabaseError
 
 
+def database_error(exn, path):
+    """
+    Convert database error to a DataError for the client.  Serialization
+    failures are returned as they are, so that the transaction can be
+    retried by the caller.
+    """
+
+    if is_serialization_failure(exn):
+        return exn
+
+    return DataError('DB: ' + exn.orig.diag.message_primary, path)
+
+
 def unescape(part):
     part = part.replace('~1', '/')
     part = part.replace('~0', '~')
@@ -121,7 +134,7 @@ class Pointer(object):
         except (ValueError, TypeError), e:
             raise DataError(e.message, self.path)
         except DatabaseError, e:
-            raise DataError('DB: ' + e.orig.diag.message_primary, self.path)
+            raise database_error(e, self.path)
 
     def add(self, value):
         """
@@ -140,7 +153,7 @@ class Pointer(object):
         except (ValueError, TypeError), e:
             raise DataError(e.message, self.path)
         except DatabaseError, e:
-            raise DataError('DB: ' + e.orig.diag.message_primary, self.path)
+            raise database_error(e, self.path)
 
     def replace(self, value):
         """
@@ -155,7 +168,7 @@ class Pointer(object):
             except (ValueError, TypeError), e:
                 raise DataError(e.message, self.path)
             except DatabaseError, e:
-                raise DataError('DB: ' + e.orig.diag.message_primary, self.path)
+                raise database_error(e, self.path)
         else:
             self.remove()
             self.add(value)
@@ -174,7 +187,7 @@ class Pointer(object):
             except (ValueError, TypeError), e:
                 raise DataError(e.message, self.path)
             except DatabaseError, e:
-                raise DataError('DB: ' + e.orig.diag.message_primary, self.path)
+                raise database_error(e, self.path)
         else:
             self.remove()
 
@@ -191,7 +204,7 @@ class Pointer(object):
             except (ValueError, TypeError), e:
                 raise DataError(e.message, self.path)
             except DatabaseError, e:
-                raise DataError('DB: ' + e.orig.diag.message_primary, self.path)
+                raise database_error(e, self.path)
         else:
             self.add(value)
 
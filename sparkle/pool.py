@@ -0,0 +1,138 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Database Connection Pool
+
+Pool of connections used by the API threads, sized to match the thread
+pool so that no thread ever waits for a connection for long.  The pool
+keeps track of how long threads actually wait for it.
+
+Every connection also prepares statements for the fixed query shapes
+used by the dbdict proxies, so that they are only planned once.
+"""
+
+__all__ = ['MeteredPool', 'prepare_statements', 'get_statement',
+           'keys_statement']
+
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError
+from threading import Lock
+from time import time
+
+from sparkle.schema import schema
+
+
+def get_statement(table):
+    """Name of statement loading row of the table by it's primary key."""
+    return 'sparkle_get_%s' % table.name
+
+
+def keys_statement(endpoint):
+    """
+    Name of statement listing primary keys of the endpoint.
+    Returns None for endpoints without a prepared statement.
+    """
+
+    if endpoint.filter or not isinstance(endpoint.table.pkey, basestring):
+        return None
+
+    if endpoint.parent.table is None:
+        return 'sparkle_keys_%s' % endpoint.table.name
+
+    return 'sparkle_keys_%s_%s' % (endpoint.table.name,
+                                   endpoint.parent.table.name)
+
+
+def prepare_statements(dbapi_conn, record):
+    """
+    Prepare statements for all tables on a new connection.
+    Meant to be used as an engine ``connect`` event listener.
+    """
+
+    statements = {}
+
+    for name, table in schema.tables.iteritems():
+        if table.virtual or not isinstance(table.pkey, basestring):
+            continue
+
+        statements[get_statement(table)] = \
+                'SELECT * FROM "%s" WHERE "%s" = $1' % (name, table.pkey)
+
+        for endpoint in table.endpoints.itervalues():
+            statement = keys_statement(endpoint)
+
+            if statement is None:
+                continue
+
+            query = 'SELECT "%s" FROM "%s"' % (table.pkey, name)
+
+            if endpoint.parent.table is not None:
+                query += ' WHERE "%s" = $1' % endpoint.parent.table.name
+
+            statements[statement] = query
+
+    cursor = dbapi_conn.cursor()
+
+    try:
+        for statement, query in sorted(statements.iteritems()):
+            cursor.execute('PREPARE %s AS %s' % (statement, query))
+    finally:
+        cursor.close()
+
+    # Prepared statements outlive the transaction.
+    dbapi_conn.commit()
+
+
+class MeteredPool(QueuePool):
+    """
+    Queue pool that measures time spent waiting for connections.
+    """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+
+        self.lock = Lock()
+        self.stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+        }
+
+    def _do_get(self):
+        started = time()
+
+        try:
+            conn = QueuePool._do_get(self)
+        except TimeoutError:
+            with self.lock:
+                self.stats['timeouts'] += 1
+            raise
+
+        waited = time() - started
+
+        with self.lock:
+            self.stats['checkouts'] += 1
+            self.stats['wait_time'] += waited
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+
+        return conn
+
+    def get_stats(self):
+        """Return usage statistics of the pool."""
+
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats.update({
+            'size': self.size(),
+            'idle': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+        })
+
+        return stats
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,362 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Model Reconciliation
+
+Desired state in the model should always match the database, but since
+it is only maintained by applying changes, any missed change would stay
+unnoticed forever.  Reconciler periodically compares checksums of the
+model and the database and re-reads parts of tables that differ.
+
+Tables are split to buckets by the leading hex digits of md5 of their
+primary keys.  Every bucket has a row count and a sum of partial row
+digests, computed by the database from the canonical ``jsonb`` text of
+the rows.  The same text is reproduced here from the model data.
+"""
+
+__all__ = ['Reconciler']
+
+from twisted.internet import task, reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+from simplejson import dumps
+from collections import Mapping
+from datetime import datetime, date, time
+from decimal import Decimal
+from hashlib import md5
+from itertools import cycle
+from psycopg2.extras import Range
+
+from sparkle.schema import schema
+
+
+# Query returning number of rows and digest for every bucket of a table.
+DIGEST_QUERY = '''
+    SELECT substr(md5(%(key)s), 1, :depth) AS bucket,
+           count(*),
+           sum(('x' || substr(md5(to_jsonb(t)::text), 1, 15))
+                    ::bit(60)::bigint)
+      FROM "%(table)s" t
+  GROUP BY 1
+'''
+
+# Query returning all rows in given buckets of a table.
+BUCKET_QUERY = '''
+    SELECT *
+      FROM "%(table)s" t
+     WHERE substr(md5(%(key)s), 1, :depth) = ANY(:buckets)
+'''
+
+
+def key_expression(table):
+    """
+    Produce SQL expression with text of table's primary key,
+    as understood by ``key_text()``.
+    """
+
+    if isinstance(table.pkey, basestring):
+        return 't."%s"::text' % table.pkey
+
+    return "concat_ws('/', %s)" \
+                % ', '.join('t."%s"::text' % key for key in table.pkey)
+
+
+def key_text(pkey):
+    """Text of the primary key for bucket assignment."""
+
+    if isinstance(pkey, tuple):
+        return u'/'.join(unicode(key) for key in pkey)
+
+    return unicode(pkey)
+
+
+def bucket_of(pkey, depth):
+    """Return bucket of given primary key."""
+    return md5(key_text(pkey).encode('utf-8')).hexdigest()[:depth]
+
+
+def range_text(value):
+    """Render range the way PostgreSQL prints it."""
+
+    if value.isempty:
+        return 'empty'
+
+    return '%s%s,%s%s' % ('[' if value.lower_inc else '(',
+                          '' if value.lower is None else value.lower,
+                          '' if value.upper is None else value.upper,
+                          ']' if value.upper_inc else ')')
+
+
+def temporal_text(value):
+    """
+    Render date or time the way PostgreSQL prints it in ``jsonb``,
+    that is without trailing zeros of the fractional seconds.
+    """
+
+    if not getattr(value, 'microsecond', 0):
+        return value.isoformat()
+
+    text = value.replace(microsecond=0).isoformat()
+    fraction = ('.%06i' % value.microsecond).rstrip('0')
+    seconds = 19 if isinstance(value, datetime) else 8
+
+    return text[:seconds] + fraction + text[seconds:]
+
+
+def jsonb_text(value):
+    """
+    Serialize value the way PostgreSQL prints ``jsonb``.
+
+    Object keys are ordered by their length first and items are
+    separated by a comma and a space.
+    """
+
+    if value is None:
+        return 'null'
+
+    if value is True:
+        return 'true'
+
+    if value is False:
+        return 'false'
+
+    if isinstance(value, (int, long, Decimal)):
+        return str(value)
+
+    if isinstance(value, float):
+        return repr(value)
+
+    if isinstance(value, (datetime, date, time)):
+        return dumps(temporal_text(value))
+
+    if isinstance(value, Range):
+        return dumps(range_text(value))
+
+    if isinstance(value, Mapping):
+        keys = sorted(value, key=lambda k: (len(k.encode('utf-8')),
+                                            k.encode('utf-8')))
+        return u'{%s}' % u', '.join(u'%s: %s' % (dumps(k, ensure_ascii=False),
+                                                 jsonb_text(value[k]))
+                                    for k in keys)
+
+    if isinstance(value, (list, tuple)):
+        return u'[%s]' % u', '.join(jsonb_text(item) for item in value)
+
+    return dumps(unicode(value), ensure_ascii=False)
+
+
+def row_digest(part):
+    """Partial digest of a row, the same one the database computes."""
+    text = jsonb_text(part).encode('utf-8')
+    return int(md5(text).hexdigest()[:15], 16)
+
+
+def model_digests(rows, depth):
+    """
+    Compute bucket digests for ``(pkey, part)`` pairs.
+    Returns mapping of buckets to ``(count, digest)`` tuples.
+    """
+
+    digests = {}
+
+    for pkey, part in rows:
+        bucket = bucket_of(pkey, depth)
+        count, total = digests.get(bucket, (0, 0))
+        digests[bucket] = (count + 1, total + row_digest(part))
+
+    return digests
+
+
+class Reconciler(object):
+    """
+    Background comparison of model desired state with the database.
+
+    Checks one table every ``interval`` seconds.  Buckets found to
+    differ twice in a row are re-read from the database, so that
+    changes still on their way to the model do not trigger anything.
+    Buckets that still differ right after their repair are reported
+    and left alone until they match again.
+    """
+
+    def __init__(self, manager, interval=10.0, depth=1):
+        self.manager = manager
+        self.interval = interval
+        self.depth = depth
+
+        # Tables are checked in turns.  Tables with a retention policy
+        # are only partially present in the model and cannot be checked.
+        self.names = cycle(sorted(name for name, table
+                                  in schema.tables.iteritems()
+                                  if not table.virtual and not table.retain))
+
+        # Buckets that have differed during the last check of a table.
+        self.suspects = {}
+
+        # Buckets repaired since the last check of a table and those
+        # that have not been fixed by their repair.
+        self.repaired = {}
+        self.stuck = {}
+
+        # Counters for monitoring purposes.
+        self.stats = {
+            'checks': 0,
+            'mismatches': 0,
+            'repairs': 0,
+            'stuck': 0,
+        }
+
+        self.looper = task.LoopingCall(self.step)
+
+    def start(self):
+        self.looper.start(self.interval, now=False)
+
+    def stop(self):
+        if self.looper.running:
+            self.looper.stop()
+
+    def step(self):
+        """
+        Check the next table and repair it if needed.
+        Holds the looping call until it is done, so checks never overlap.
+        """
+
+        name = next(self.names)
+
+        # Rows are replaced and never modified in place, so a shallow
+        # copy is safe to examine in a thread.
+        rows = list(self.manager.model.desired[name].iteritems())
+
+        def failure(reason):
+            print 'reconciliation of %r failed: %s' \
+                        % (name, reason.getErrorMessage())
+
+        d = deferToThread(self.compare, name, rows)
+        d.addCallback(self.confirm, name)
+        d.addCallback(self.repair, name)
+        d.addErrback(failure)
+        return d
+
+    def compare(self, name, rows):
+        """
+        Compare table with the database and return buckets that differ.
+        Runs in a thread.
+        """
+
+        table = schema.tables[name]
+        params = {'key': key_expression(table), 'table': name}
+        db = self.manager.db
+
+        try:
+            remote = {}
+
+            for bucket, count, total in \
+                    db.execute(DIGEST_QUERY % params,
+                               params={'depth': self.depth}):
+                remote[bucket] = (count, int(total))
+
+        finally:
+            db.rollback()
+
+        local = model_digests(rows, self.depth)
+
+        return set(bucket for bucket in set(remote).union(local)
+                   if remote.get(bucket) != local.get(bucket))
+
+    def confirm(self, differ, name):
+        """
+        Pick buckets to repair out of those found to differ, that is
+        the ones that have differed during the last check as well.
+        """
+
+        self.stats['checks'] += 1
+        self.stats['mismatches'] += len(differ)
+
+        # Buckets that match again are no longer stuck.
+        stuck = self.stuck.setdefault(name, set())
+        stuck.intersection_update(differ)
+
+        failed = differ.intersection(self.repaired.pop(name, ()))
+
+        for bucket in sorted(failed):
+            print 'bucket %s of %r still differs after repair, ' \
+                  'not repairing it again' % (bucket, name)
+
+        stuck.update(failed)
+        self.stats['stuck'] = sum(len(b) for b in self.stuck.itervalues())
+
+        differ = differ.difference(stuck)
+        confirmed = differ.intersection(self.suspects.get(name, ()))
+        self.suspects[name] = differ.difference(confirmed)
+
+        return confirmed
+
+    def repair(self, buckets, name):
+        """
+        Re-read differing buckets and replace them in the model.
+
+        Runs in turn with deliveries of the listener, so that changes
+        newer than the rows read are applied after them and do not
+        get overwritten.
+        """
+
+        if not buckets:
+            return None
+
+        done = Deferred()
+
+        def run():
+            d = deferToThread(self.fetch, name, buckets)
+            d.addCallback(self.replace, name, buckets)
+            d.chainDeferred(done)
+            return d
+
+        self.manager.listener.enqueue(run)
+        return done
+
+    def fetch(self, name, buckets):
+        """
+        Read rows of given buckets of the table.  Runs in a thread.
+        """
+
+        table = schema.tables[name]
+        params = {'key': key_expression(table), 'table': name}
+        db = self.manager.db
+        fetched = []
+
+        try:
+            for row in db.execute(BUCKET_QUERY % params,
+                                  params={'depth': self.depth,
+                                          'buckets': sorted(buckets)}):
+                part = dict(row)
+                fetched.append((table.primary_key(part), part))
+        finally:
+            db.rollback()
+
+        return fetched
+
+    def replace(self, fetched, name, buckets):
+        """
+        Replace desired state of the buckets with rows fetched from
+        the database.
+        """
+
+        present = set(pkey for pkey, part in fetched)
+
+        changes = [(name, pkey, 'desired', part) for pkey, part in fetched]
+
+        for pkey in self.manager.model.desired[name]:
+            if pkey not in present and bucket_of(pkey, self.depth) in buckets:
+                changes.append((name, pkey, 'desired', None))
+
+        print 'reconciling %i rows of %r in buckets %s' \
+                    % (len(changes), name, ', '.join(sorted(buckets)))
+
+        self.stats['repairs'] += len(buckets)
+        self.repaired[name] = set(buckets)
+
+        self.manager.overlay.load(changes)
+        self.manager.overlay.commit()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,105 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Table Reflection
+
+SQLSoup reflects tables lazily, on their first use.  That makes first
+requests touching every table rather slow, so we reflect all of them at
+once during startup instead.  The reflected metadata can be cached on
+disk and reused as long as the database schema does not change.
+
+Reflected tables also carry tuples with names of their columns in the
+``columns`` key of their ``info`` dictionaries.
+"""
+
+__all__ = ['load_metadata', 'map_tables', 'schema_version']
+
+from sqlalchemy import MetaData
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from os import rename
+
+from sparkle.schema import schema
+
+
+# Query producing hash of all columns and constraints in our schema.
+VERSION_QUERY = '''
+    SELECT md5(coalesce(string_agg(item, ',' ORDER BY item), ''))
+      FROM (SELECT concat_ws(':', table_name, ordinal_position, column_name,
+                             data_type, udt_name, is_nullable,
+                             column_default) AS item
+              FROM information_schema.columns
+             WHERE table_schema = current_schema()
+         UNION ALL
+            SELECT concat_ws(':', table_name, constraint_name,
+                             constraint_type)
+              FROM information_schema.table_constraints
+             WHERE table_schema = current_schema()) AS items
+'''
+
+
+def schema_version(engine):
+    """Return hash identifying current version of the database schema."""
+    return engine.execute(VERSION_QUERY).scalar()
+
+
+def table_names():
+    """Names of tables backing our schema."""
+    return sorted(name for name, table in schema.tables.iteritems()
+                  if not table.virtual)
+
+
+def load_metadata(engine, path=None):
+    """
+    Reflect all tables of our schema at once and return the metadata.
+
+    With ``path``, metadata cached in that file are used if they match
+    current version of the database schema.  Otherwise the file is
+    replaced with freshly reflected metadata.
+    """
+
+    names = table_names()
+    version = None
+
+    if path is not None:
+        version = schema_version(engine)
+
+        try:
+            with open(path, 'rb') as fp:
+                cached_version, metadata = load(fp)
+
+            if cached_version == version \
+               and set(names).issubset(metadata.tables):
+                metadata.bind = engine
+                return metadata
+
+        except Exception, e:
+            print 'not using metadata cache %r: %s' % (path, e)
+
+    metadata = MetaData(engine)
+    metadata.reflect(only=names)
+
+    for table in metadata.tables.itervalues():
+        table.info['columns'] = tuple(table.c.keys())
+
+    if path is not None:
+        try:
+            with open(path + '.tmp', 'wb') as fp:
+                dump((version, metadata), fp, HIGHEST_PROTOCOL)
+
+            rename(path + '.tmp', path)
+
+        except Exception, e:
+            print 'failed to write metadata cache %r: %s' % (path, e)
+
+    return metadata
+
+
+def map_tables(db):
+    """Map all tables of our schema to classes of the SQLSoup instance."""
+
+    for name in table_names():
+        getattr(db, name)
+
+
+# vim:set sw=4 ts=4 et:
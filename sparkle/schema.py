@@ -93,6 +93,7 @@ class Table(object):
         self.user_pkey = table.get('user-pkey', self.pkey != 'uuid')
         self.endpoints = {}
         self.join = set(table.get('join', []))
+        self.retain = table.get('retain')
 
         if not isinstance(self.pkey, basestring) and not self.join:
             self.join = self.pkey
@@ -1,14 +1,224 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['Twilight']
+__all__ = ['Twilight', 'Outbox']
 
-from twisted.internet import task
+from twisted.internet import task, reactor
+from simplejson import dumps
+from collections import deque
 from uuid import uuid4
 
 from sparkle.schema import schema
 
 
+# Tables Twilights are allowed to report current state for.
+CURRENT_TABLES = ('host', 'nic', 'bond', 'net_role', 'host_disk',
+                  'host_storage_pool', 'host_image', 'host_extent',
+                  'host_volume')
+
+# Minimal delay between two reports of invalid updates from one host.
+REPORT_INTERVAL = 15.0
+
+
+def make_key_validator(table):
+    """
+    Create function that checks whether the primary key from a change
+    record matches the one found in the row payload.
+
+    Composite keys are compared column by column with their order
+    precomputed so that nothing needs to be looked up in the schema
+    when the function gets called.
+    """
+
+    if isinstance(table.pkey, basestring):
+        column = table.pkey
+
+        def valid_key(pkey, part):
+            # Primary key is a single column, which needs to be present
+            # in the payload and match the key from the change record.
+            return column in part and part[column] == pkey
+
+    else:
+        columns = tuple(enumerate(table.pkey))
+        width = len(columns)
+
+        def valid_key(pkey, part):
+            # All key parts must be present in the payload and match
+            # the parts given in the change record.
+            if not isinstance(pkey, (list, tuple)) or len(pkey) != width:
+                return False
+
+            for i, column in columns:
+                if column not in part or part[column] != pkey[i]:
+                    return False
+
+            return True
+
+    return valid_key
+
+
+def make_row_validators(schema):
+    """
+    Prepare mapping of table names to current state row validators.
+
+    Only tables Twilights may report are present in the result, which
+    makes it double as a cheap check for acceptable tables.
+    """
+
+    return {name: make_key_validator(schema.tables[name])
+            for name in CURRENT_TABLES}
+
+
+# Validators shared by all Twilights, generated once from the schema.
+validators = make_row_validators(schema)
+
+
+def change_size(change):
+    """Estimated size of a change within an encoded update."""
+
+    # Account for the separator, too.
+    return len(dumps(change, for_json=True)) + 2
+
+
+class Outbox(object):
+    """
+    Bounded queue of messages waiting to be sent to a single peer.
+
+    Updates queued right after another update are merged into it, so that
+    superseded versions of rows are never sent.  The queue is limited by
+    both number of messages and their estimated encoded size.
+    """
+
+    def __init__(self, max_messages=None, max_bytes=None):
+        # Limits of the queue, None for no limit.
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+
+        # Queued messages with their estimated sizes and the total.
+        # Sizes are maintained as messages come and go, so that we never
+        # need to encode the whole queue again.
+        self.messages = deque()
+        self.sizes = deque()
+        self.bytes = 0
+
+        # Mapping of `(name, pkey)` to position in the changes of the
+        # last queued update.  None until anything gets merged into it.
+        self.tail = None
+
+        # Estimated sizes of individual changes of the last queued update,
+        # in the same order.  Only valid together with the tail.
+        self.tail_sizes = None
+
+        # Number of messages discarded due to overflows.
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def push(self, message):
+        """
+        Queue message for sending.
+
+        Returns True if the message have been queued on it's own or False
+        if it's changes have been merged into the preceding update.
+        """
+
+        if message.get('event') == 'update' and self.messages \
+           and self.messages[-1].get('event') == 'update':
+            self.merge(message['changes'])
+            return False
+
+        size = len(dumps(message, for_json=True))
+        self.messages.append(message)
+        self.sizes.append(size)
+        self.bytes += size
+        self.tail = None
+        return True
+
+    def merge(self, changes):
+        """Merge changes into the last queued update."""
+
+        tail = self.messages[-1]
+
+        if self.tail is None:
+            # Take ownership of the changes before we modify them.
+            tail['changes'] = list(tail['changes'])
+            self.tail = {tuple(change[:2]): i
+                         for i, change in enumerate(tail['changes'])}
+            self.tail_sizes = [change_size(change)
+                               for change in tail['changes']]
+
+        delta = 0
+
+        for change in changes:
+            row = tuple(change[:2])
+            size = change_size(change)
+
+            if row in self.tail:
+                i = self.tail[row]
+                tail['changes'][i] = change
+                delta += size - self.tail_sizes[i]
+                self.tail_sizes[i] = size
+            else:
+                self.tail[row] = len(tail['changes'])
+                tail['changes'].append(change)
+                self.tail_sizes.append(size)
+                delta += size
+
+        self.sizes[-1] += delta
+        self.bytes += delta
+
+    def peek(self):
+        """Return the oldest queued message."""
+        return self.messages[0]
+
+    def pop(self):
+        """Remove the oldest queued message."""
+
+        self.messages.popleft()
+        self.bytes -= self.sizes.popleft()
+
+        if not self.messages:
+            self.tail = None
+
+    def discard_updates(self):
+        """Remove all queued updates, leaving other messages in place."""
+
+        kept = [(message, size)
+                for message, size in zip(self.messages, self.sizes)
+                if message.get('event') != 'update']
+
+        self.messages = deque(message for message, size in kept)
+        self.sizes = deque(size for message, size in kept)
+        self.bytes = sum(self.sizes)
+        self.tail = None
+
+    def clear(self):
+        """Discard all queued messages."""
+
+        self.dropped += len(self.messages)
+        self.messages.clear()
+        self.sizes.clear()
+        self.bytes = 0
+        self.tail = None
+
+    def overflowing(self):
+        """Determine whether the queue exceeds any of it's limits."""
+
+        if self.max_messages is not None \
+           and len(self.messages) > self.max_messages:
+            return True
+
+        if self.max_bytes is not None and self.messages \
+           and self.bytes > self.max_bytes:
+            return True
+
+        return False
+
+
 class Twilight(object):
     """Device for communication with an individual host worker."""
 
@@ -43,6 +253,17 @@ class Twilight(object):
         # send to the peer.  Used to send changes per-transaction.
         self.pending = set()
 
+        # Messages the router have not yet accepted for the peer.
+        self.outbox = Outbox(manager.max_queue_messages,
+                             manager.max_queue_bytes)
+
+        # Invalid changes waiting to be reported, with just the first one
+        # kept as an example.  Reported in batches to keep a misbehaving
+        # host from flooding the log from the reactor thread.
+        self.invalid = 0
+        self.invalid_example = None
+        self.invalid_report = None
+
         # Send keep-alive message every few seconds.
         self.keep_alive = task.LoopingCall(self.send_changes, [])
         self.keep_alive.start(15.0)
@@ -51,9 +272,12 @@ class Twilight(object):
         """Called to notify us about a changed row."""
         self.pending.add((name, pkey))
 
-    def send_pending_changes(self):
+    def send_pending_changes(self, flush=True):
         """
         Send any pending changes in one transaction.
+
+        With ``flush`` disabled the changes are only queued and caller
+        is responsible for flushing them later.
         """
 
         changes = []
@@ -68,25 +292,66 @@ class Twilight(object):
         self.pending.clear()
 
         if changes:
-            self.send_changes(changes)
+            self.send_changes(changes, flush)
 
-    def send(self, message):
-        """Send a message to our peer."""
-        self.manager.router.send(message, self.peer)
+    def send(self, message, flush=True):
+        """
+        Send a message to our peer.
 
-    def send_changes(self, changes=[]):
+        Returns False if the message have been merged into a previously
+        queued update instead of being queued on it's own.
+        """
+
+        queued = self.outbox.push(message)
+
+        if flush:
+            self.flush()
+
+        return queued
+
+    def flush(self):
+        """Pass queued messages to the router."""
+        batch = [(message, self.peer) for message in self.outbox]
+        self.delivered(self.manager.router.send_many(batch))
+
+    def delivered(self, results):
+        """
+        Remove messages the router have accepted from the queue, given
+        results of ``Router.send_many()`` for all queued messages.
+
+        When the peer does not keep up and the queue grows over it's
+        limits, all queued messages are discarded.  The peer will notice
+        the gap in sequence numbers and request a resync.
+        """
+
+        for sent in results:
+            if not sent:
+                break
+
+            self.outbox.pop()
+
+        if self.outbox.overflowing():
+            print '[host %r] outgoing queue overflow, dropping %i messages' \
+                        % (self.uuid, len(self.outbox))
+            self.outbox.clear()
+
+    def send_changes(self, changes=[], flush=True):
         """
         Send a bulk of changes to the peer and bump the sequence number.
+
+        Changes are merged into a queued update when the peer have not
+        yet accepted it, in which case the sequence number stays.
         """
 
-        self.send({
+        queued = self.send({
             'event': 'update',
             'incarnation': self.local_incarnation,
             'seq': self.local_sequence,
             'changes': changes,
-        })
+        }, flush)
 
-        self.local_sequence += 1
+        if queued:
+            self.local_sequence += 1
 
     def receive(self, message, peer):
         """
@@ -96,6 +361,10 @@ class Twilight(object):
         # Update route to the peer.
         self.peer = peer
 
+        # Peer is obviously alive, try to deliver what it have missed.
+        if self.outbox:
+            self.flush()
+
         # Extract type of the event.
         event = message['event']
 
@@ -118,6 +387,9 @@ class Twilight(object):
 
         self.local_sequence = 0
 
+        # Queued updates are superseded by the full state.
+        self.outbox.discard_updates()
+
         changes = []
         for name, pkeys in self.desired.iteritems():
             for pkey in pkeys:
@@ -167,43 +439,23 @@ class Twilight(object):
         things there.  This is more for finding bugs than anything else.
         """
 
-        # Accept only desired state.
+        # Accept only current state.
         if state != 'current':
             return False
 
         # We only accept data for a few tables.
-        if name not in set(('host', 'nic', 'bond', 'net_role', 'host_disk',
-                            'host_storage_pool', 'host_image', 'host_extent',
-                            'host_volume')):
+        valid_key = validators.get(name)
+
+        if valid_key is None:
             return False
 
         if part is not None:
-            # Valid data must be a dict.
+            # Valid data must be a dict with matching primary key.
             if not isinstance(part, dict):
                 return False
 
-            if isinstance(schema.tables[name].pkey, basestring):
-                # Primary key is a single column, which needs to
-                # be present in the payload.
-                if schema.tables[name].pkey not in part:
-                    return False
-
-                # And match the primary key specified in the change record.
-                if part[schema.tables[name].pkey] != pkey:
-                    return False
-
-            else:
-                # In this case, we have a multi-column primary key.
-                for i in xrange(len(schema.tables[name].pkey)):
-                    key = schema.tables[name].pkey[i]
-
-                    # All key parts must be present in the payload.
-                    if key not in part:
-                        return False
-
-                    # And match the parts given in the change record.
-                    if part[key] != pkey[i]:
-                        return False
+            if not valid_key(pkey, part):
+                return False
 
         # Entity seems acceptable.
         return True
@@ -212,6 +464,8 @@ class Twilight(object):
         """
         Filter rows approved by ``self.valid_row()`` while converting
         composite primary keys from lists to tuples.
+
+        Rejected rows are reported via ``self.report_invalid()``.
         """
 
         for change in changes:
@@ -220,8 +474,47 @@ class Twilight(object):
                     change[1] = tuple(change[1])
                 yield change
             else:
-                print '[host %r] invalid update: %r' \
-                            % (self.uuid, change)
+                self.report_invalid(change)
+
+    def report_invalid(self, change):
+        """
+        Schedule invalid change to be reported.
+
+        Invalid changes are counted and reported at most once every
+        ``REPORT_INTERVAL`` seconds along with the first offender.
+        """
+
+        self.invalid += 1
+
+        if self.invalid_example is None:
+            self.invalid_example = change
+
+        if self.invalid_report is None:
+            self.invalid_report = \
+                    reactor.callLater(REPORT_INTERVAL, self.flush_invalid)
+
+    def flush_invalid(self):
+        """Print summary of invalid changes collected so far."""
+
+        print '[host %r] %i invalid updates, first: %r' \
+                    % (self.uuid, self.invalid, self.invalid_example)
+
+        self.invalid = 0
+        self.invalid_example = None
+        self.invalid_report = None
+
+    def disconnect(self):
+        """
+        Stop talking to the host once it is being dropped.
+        Invalid updates collected so far are reported right away.
+        """
+
+        if self.keep_alive.running:
+            self.keep_alive.stop()
+
+        if self.invalid_report is not None:
+            self.invalid_report.cancel()
+            self.flush_invalid()
 
     def merge_current(self, changes):
         """
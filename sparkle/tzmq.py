@@ -1,18 +1,159 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['Router']
+__all__ = ['Router', 'RouterGroup']
 
 import zmq
+import zlib
 
+from binascii import crc32
 from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 from twisted.internet.interfaces import IFileDescriptor, IReadDescriptor
 from zope.interface import implements
 from simplejson import loads, dumps
+from collections import deque
+from decimal import Decimal
+from struct import pack, unpack, error as StructError
 from time import time
+from traceback import print_exc
 
 from uuid import uuid4
 
+# MessagePack and LZ4 are optional, we fall back to JSON and zlib.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+# Delay before we check whether a congested socket accepts messages again.
+RETRY_DELAY = 0.25
+
+# Message key used to advertise supported encodings in JSON messages.
+ACCEPT_KEY = 'x-accept'
+
+# Encodings we are able to decode, in the order of preference.
+SERIALIZERS = (['msgpack'] if msgpack else []) + ['json']
+COMPRESSORS = (['lz4'] if lz4 else []) + ['zlib']
+
+
+def pack_default(obj):
+    """
+    Serialize custom objects for MessagePack the way simplejson does.
+    Decimals become floats, just like when JSON is decoded.
+    """
+
+    if hasattr(obj, 'for_json'):
+        return obj.for_json()
+
+    if isinstance(obj, Decimal):
+        return float(obj)
+
+    raise TypeError('%r is not serializable' % (obj,))
+
+
+def encode(message, serializer, compressor=None, threshold=None):
+    """
+    Encode message using given serializer and optionally compress it
+    if it's size exceeds the threshold.
+
+    Returns tuple of the encoded data and codec name such as
+    ``msgpack+zlib`` to be sent along with the data.
+    """
+
+    if serializer == 'msgpack':
+        data = msgpack.packb(message, default=pack_default,
+                             use_bin_type=False)
+    else:
+        data = dumps(message, for_json=True)
+
+    if compressor is None or threshold is None or len(data) <= threshold:
+        return data, serializer
+
+    if compressor == 'lz4':
+        data = lz4.compress(data)
+    else:
+        data = zlib.compress(data, 1)
+
+    return data, serializer + '+' + compressor
+
+
+def decode(data, codec):
+    """
+    Decode message encoded using the ``encode()`` function.
+    Raises ValueError for unsupported codecs or malformed data.
+
+    The data can also be a buffer, which is only copied when
+    the codec does not support buffers.
+    """
+
+    serializer, _, compressor = codec.partition('+')
+
+    try:
+        if compressor == 'lz4' and lz4 is not None:
+            data = lz4.decompress(data)
+        elif compressor == 'zlib':
+            data = zlib.decompress(data)
+        elif compressor:
+            raise ValueError('unsupported compression %r' % (compressor,))
+    except (zlib.error, RuntimeError), e:
+        raise ValueError('decompression failed: %s' % (e,))
+
+    if serializer == 'msgpack' and msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+
+    if serializer == 'json':
+        return loads(str(data))
+
+    raise ValueError('unsupported serialization %r' % (serializer,))
+
+
+def negotiate(accept):
+    """
+    Select encoding for a peer that advertised given comma-separated
+    list of encodings it understands.
+
+    Returns tuple of serializer and compressor names or None when the
+    peer should be sent plain JSON messages.
+    """
+
+    if not accept:
+        return None
+
+    accept = set(accept.split(','))
+
+    for serializer in SERIALIZERS:
+        if serializer in accept:
+            break
+    else:
+        return None
+
+    for compressor in COMPRESSORS:
+        if compressor in accept:
+            return serializer, compressor
+
+    return serializer, None
+
+
+class Inbound(object):
+    """
+    Received message waiting to be decoded and dispatched.
+    """
+
+    __slots__ = ['sender', 'accept', 'done', 'message']
+
+    def __init__(self, sender, accept):
+        self.sender = sender
+        self.accept = accept
+        self.done = False
+        self.message = None
+
 
 class Router(object):
     """
@@ -21,7 +162,9 @@ class Router(object):
 
     implements(IReadDescriptor, IFileDescriptor)
 
-    def __init__(self, identity=None, default_recipient=None):
+    def __init__(self, identity=None, default_recipient=None,
+                 hwm=None, mandatory=False, compress_threshold=None,
+                 read_budget=100, decode_threshold=None, context=None):
         """
         Prepares ZMQ socket.
 
@@ -33,9 +176,37 @@ class Router(object):
         Every message contains a timestamp that is checked by recipient.
         If the time difference is larger than 15 seconds, message is dropped.
         Make sure your machines use NTP to synchronize their clocks.
+
+        Messages are JSON-encoded and advertise encodings we understand.
+        Once a peer advertises it's own, we switch to a binary envelope
+        with the best common encoding, compressing messages larger than
+        ``compress_threshold`` bytes.  Peers that only speak JSON keep
+        receiving JSON and simply ignore the advertisement.
+
+        The ``hwm`` limits number of outgoing messages queued for every
+        peer.  ROUTER sockets silently drop messages over the limit,
+        unless they are made ``mandatory``.  In that case the send method
+        reports the failure and caller can try again later.  When the
+        failure is caused by a full queue, ``on_writable`` gets called
+        once the socket accepts messages again.
+
+        At most ``read_budget`` messages are received and dispatched per
+        reactor iteration, taking turns among senders.  Rest is left for
+        the following iterations so that other events get their chance.
+
+        Messages larger than ``decode_threshold`` bytes are decoded in
+        the reactor thread pool.  Messages from every sender are still
+        dispatched in the order they have been received.
+
+        Sockets are created in the global 0MQ context, unless a different
+        ``context`` is given.
         """
+        # Use the global context by default.
+        if context is None:
+            context = zmq.Context.instance()
+
         # Create the 0MQ socket.
-        self.socket = zmq.Context.instance().socket(zmq.ROUTER)
+        self.socket = context.socket(zmq.ROUTER)
 
         # Assume either user-specified identity or generate our own.
         if identity is not None:
@@ -43,9 +214,54 @@ class Router(object):
         else:
             self.socket.setsockopt(zmq.IDENTITY, str(uuid4()))
 
+        # Limit the per-peer outgoing queues.
+        if hwm is not None:
+            self.socket.setsockopt(zmq.SNDHWM, hwm)
+
+        # Report unroutable messages instead of dropping them.
+        if mandatory:
+            self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+
         # Remember the default recipient.
         self.default_recipient = default_recipient
 
+        # Encodings negotiated with individual peers.
+        self.encodings = {}
+
+        # Advertisement of encodings we support.
+        self.accept = ','.join(SERIALIZERS + COMPRESSORS)
+
+        # Size of messages above which they get compressed.
+        self.compress_threshold = compress_threshold
+
+        # Maximum number of messages handled per reactor iteration.
+        self.read_budget = read_budget
+
+        # Size of messages to be decoded outside of the reactor thread.
+        self.decode_threshold = decode_threshold
+
+        # Received messages waiting to be dispatched, per sender.
+        # Senders take turns in the order they are listed in ready.
+        # Only senders with their oldest message decoded are ready.
+        self.inbox = {}
+        self.ready = deque()
+
+        # Counters of received and dropped messages.
+        self.stats = {
+            'received': 0,
+            'dispatched': 0,
+            'stale': 0,
+            'invalid': 0,
+            'offloaded': 0,
+        }
+
+        # Read planned for the next reactor iteration, if any.
+        self.reading = None
+
+        # Delayed call checking whether the socket accepts messages
+        # again after a send have failed due to a full queue.
+        self.retry = None
+
         # Register ourselves with Twisted reactor loop.
         reactor.addReader(self)
 
@@ -54,25 +270,238 @@ class Router(object):
 
     def shutdown(self):
         reactor.removeReader(self)
+
+        if self.reading is not None:
+            self.reading.cancel()
+            self.reading = None
+
+        if self.retry is not None:
+            self.retry.cancel()
+            self.retry = None
+
         self.socket.close()
 
     def connectionLost(self, reason):
         pass
 
     def doRead(self):
+        # We are reading now, any planned read would be redundant.
+        if self.reading is not None:
+            if self.reading.active():
+                self.reading.cancel()
+            self.reading = None
+
+        received = self.receive()
+        self.dispatch()
+
+        # Continue in the next iteration if we have not drained the socket
+        # or the inbox.  The socket would not wake us up on it's own.
+        if self.ready or received >= self.read_budget:
+            self.schedule_read()
+
+    def receive(self):
+        """
+        Move up to ``read_budget`` messages from the socket to the inbox.
+        Returns number of messages received.
+        """
+
+        received = 0
+
         events = self.socket.getsockopt(zmq.EVENTS)
         if events & zmq.POLLIN:
-            while True:
+            while received < self.read_budget:
                 try:
-                    sender, data, t = self.socket.recv_multipart(zmq.NOBLOCK)
-                    if int(t) + 15 < time():
-                        continue
-                    self.on_message(loads(data), sender)
+                    frames = self.socket.recv_multipart(zmq.NOBLOCK,
+                                                        copy=False)
                 except zmq.ZMQError, e:
                     if e.errno == zmq.EAGAIN:
                         break
                     raise
 
+                received += 1
+                item = self.unwrap(frames)
+
+                if item is None:
+                    continue
+
+                if item.sender not in self.inbox:
+                    self.inbox[item.sender] = deque()
+
+                queue = self.inbox[item.sender]
+                queue.append(item)
+
+                if item.done and queue[0] is item:
+                    self.ready.append(item.sender)
+
+        self.stats['received'] += received
+        return received
+
+    def dispatch(self):
+        """
+        Pass up to ``read_budget`` messages from the inbox to
+        ``on_message``, one message per sender in turns.
+        """
+
+        dispatched = 0
+
+        while self.ready and dispatched < self.read_budget:
+            sender = self.ready.popleft()
+            queue = self.inbox[sender]
+            item = queue.popleft()
+
+            if not queue:
+                del self.inbox[sender]
+            elif queue[0].done:
+                self.ready.append(sender)
+
+            if item.message is None:
+                # Failed to decode.
+                continue
+
+            dispatched += 1
+            self.stats['dispatched'] += 1
+
+            try:
+                self.on_message(item.message, sender)
+            except Exception:
+                # Do not let a single message stall everyone else.
+                print 'failed to handle message from %r:' % (sender,)
+                print_exc()
+
+    def unwrap(self, frames):
+        """
+        Parse received frames and start decoding the message.
+
+        Returns an Inbound item or None when the message is to be dropped.
+        Large messages are decoded in a thread and the item is completed
+        later on.
+        """
+
+        try:
+            if len(frames) == 3:
+                # Plain JSON message with a decimal timestamp.
+                sender, data, t = frames
+                t = int(t.bytes)
+                codec = 'json'
+                accept = None
+
+            elif len(frames) == 5:
+                # Binary envelope with packed timestamp and codec.
+                sender, data, t, codec, accept = frames
+                t = unpack('!Q', t.bytes)[0]
+                codec = codec.bytes
+                accept = accept.bytes
+
+            else:
+                raise ValueError('%i frames' % len(frames))
+
+        except (ValueError, StructError), e:
+            print 'dropping malformed message from %r: %s' \
+                        % (frames[0].bytes, e)
+            self.stats['invalid'] += 1
+            return None
+
+        sender = sender.bytes
+
+        if t + 15 < time():
+            self.stats['stale'] += 1
+            return None
+
+        item = Inbound(sender, accept)
+
+        if self.decode_threshold is not None \
+           and len(data) > self.decode_threshold:
+            # Hand the buffer over without copying it.
+            self.stats['offloaded'] += 1
+            self.track(deferToThread(decode, buffer(data), codec), item)
+            return item
+
+        try:
+            self.decoded(decode(data.bytes, codec), item)
+        except Exception, e:
+            self.failed(e, item)
+
+        return item
+
+    def track(self, d, item):
+        """
+        Complete the item once the Deferred with it's decoded message
+        fires.  The sender is made ready even when anything fails, so
+        that it's later messages do not get stuck behind the item.
+        """
+
+        d.addCallback(self.decoded, item)
+        d.addErrback(self.failed, item)
+        d.addCallback(self.completed)
+        return d
+
+    def decoded(self, message, item):
+        """Complete item with decoded message and negotiate encoding."""
+
+        item.done = True
+        item.message = message
+
+        if item.accept is None and isinstance(message, dict):
+            # Plain JSON messages advertise encodings inline.
+            item.accept = message.pop(ACCEPT_KEY, None)
+
+        # Peers without advertisement only understand JSON.
+        encoding = negotiate(item.accept)
+
+        if encoding is None:
+            self.encodings.pop(item.sender, None)
+        else:
+            self.encodings[item.sender] = encoding
+
+        return item
+
+    def failed(self, reason, item):
+        """Complete item with a message that could not be decoded."""
+
+        print 'dropping message from %r: %s' \
+                    % (item.sender, getattr(reason, 'value', reason))
+
+        self.stats['invalid'] += 1
+        item.done = True
+        return item
+
+    def completed(self, item):
+        """Make sender ready after it's oldest message got decoded."""
+
+        if self.inbox[item.sender][0] is item:
+            self.ready.append(item.sender)
+            self.schedule_read()
+
+    def wrap(self, message, recipient):
+        """Encode message for given recipient into frames."""
+
+        encoding = self.encodings.get(recipient)
+
+        if encoding is None:
+            # Peer might only understand JSON, so use that and advertise
+            # our encodings in the message itself.
+            if isinstance(message, dict):
+                message = dict(message)
+                message[ACCEPT_KEY] = self.accept
+
+            json = dumps(message, for_json=True)
+            return [recipient, json, str(int(time()))]
+
+        serializer, compressor = encoding
+        data, codec = encode(message, serializer, compressor,
+                             self.compress_threshold)
+        return [recipient, data, pack('!Q', int(time())), codec, self.accept]
+
+    def check_writable(self):
+        """Notify user if the socket accepts messages again."""
+
+        self.retry = None
+
+        if self.socket.getsockopt(zmq.EVENTS) & zmq.POLLOUT:
+            self.on_writable()
+        else:
+            self.retry = reactor.callLater(RETRY_DELAY, self.check_writable)
+
     def connect(self, address):
         """Connects to ZMQ endpoint."""
         self.socket.connect(address)
@@ -87,33 +516,196 @@ class Router(object):
         """Method called for every received message. Override."""
         raise NotImplementedError('You need to override on_message()')
 
+    def on_writable(self):
+        """
+        Method called when the socket can accept messages again after
+        a failed send.  Override.
+        """
+
     def send(self, message, recipient=None):
-        """Send message to specified peer."""
+        """
+        Send message to specified peer.
+
+        Returns False if the message could not be queued, because the
+        peer is either not connected or it's queue is full.  This can only
+        happen with ``mandatory`` routing.  Otherwise returns True.
+        """
+
+        return self.send_many([(message, recipient)])[0]
+
+    def send_many(self, messages):
+        """
+        Send multiple messages at once.
+
+        Takes sequence of ``(message, recipient)`` pairs and returns list
+        of send results as described for ``send()``.  Once a message for
+        a recipient fails, following messages for the same recipient are
+        skipped to preserve their order.
+        """
+
+        results = []
+        failed = set()
+
+        for message, recipient in messages:
+            # If recipient have not been specified, use the default one.
+            if recipient is None:
+                # But fail if no default have been set.
+                if self.default_recipient is None:
+                    raise TypeError('no recipient specified')
+
+                # Otherwise just use the default and save user some work.
+                recipient = self.default_recipient
 
-        # If recipient have not been specified, use the default one.
-        if recipient is None:
-            # But fail if no default have been set.
-            if self.default_recipient is None:
-                raise TypeError('no recipient specified')
+            if recipient in failed:
+                results.append(False)
+                continue
 
-            # Otherwise just use the default and save user some work.
-            recipient = self.default_recipient
+            sent = self.deliver(message, recipient)
 
-        # JSON-encode the message.
-        json = dumps(message, for_json=True)
+            if not sent:
+                failed.add(recipient)
 
-        # Send the message.
-        self.socket.send_multipart([recipient, json, str(int(time()))])
+            results.append(sent)
 
         # Check for potential replies.
         # This is absolutely essential to do, because Twisted is going to
         # miss replies received during the send_multipart() above.
-        reactor.callLater(0, self.doRead)
+        self.schedule_read()
+
+        return results
+
+    def deliver(self, message, recipient):
+        """Encode and pass single message to the socket."""
+
+        # Encode the message for the recipient.
+        frames = self.wrap(message, recipient)
+
+        try:
+            # Send the message.
+            self.socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.ZMQError, e:
+            if e.errno not in (zmq.EAGAIN, zmq.EHOSTUNREACH):
+                raise
+
+            # Notify user when congestion subsides.  There is nothing
+            # to wait for when the peer is not connected at all.
+            if e.errno == zmq.EAGAIN and self.retry is None:
+                self.retry = reactor.callLater(RETRY_DELAY,
+                                               self.check_writable)
+
+            # Peer is either not connected or does not keep up.
+            return False
+
+        return True
+
+    def schedule_read(self):
+        """Plan a read in the next reactor iteration unless already planned."""
+
+        if self.reading is None:
+            self.reading = reactor.callLater(0, self.doRead)
 
     def logPrefix(self):
         return 'tzmq'
 
 
+class RouterGroup(object):
+    """
+    Multiple routers acting as a single one.
+
+    Allows to spread peers over several sockets, for example one per
+    network segment or several with peers picking one by a hash of their
+    identity.  Messages from all routers are passed to a common
+    ``on_message`` and replies are sent through the router their
+    recipient have last been heard from.
+    """
+
+    def __init__(self, routers):
+        # Routers we are composed of.
+        self.routers = list(routers)
+
+        # Mapping of peers to the router we have last heard them from.
+        self.routes = {}
+
+        for router in self.routers:
+            router.on_message = self.make_handler(router)
+            router.on_writable = self.writable
+
+    def make_handler(self, router):
+        """Create message handler remembering where peers come from."""
+
+        def handler(message, sender):
+            self.routes[sender] = router
+            self.on_message(message, sender)
+
+        return handler
+
+    def writable(self):
+        self.on_writable()
+
+    @property
+    def stats(self):
+        """Counters of all routers summed up."""
+
+        stats = {}
+
+        for router in self.routers:
+            for key, value in router.stats.iteritems():
+                stats[key] = stats.get(key, 0) + value
+
+        return stats
+
+    def route(self, recipient):
+        """
+        Determine router for given recipient.  Peers we have not heard
+        from yet are assigned by a hash of their identity.
+        """
+
+        if recipient in self.routes:
+            return self.routes[recipient]
+
+        return self.routers[crc32(recipient) % len(self.routers)]
+
+    def shutdown(self):
+        for router in self.routers:
+            router.shutdown()
+
+    def on_message(self, message, sender):
+        """Method called for every received message. Override."""
+        raise NotImplementedError('You need to override on_message()')
+
+    def on_writable(self):
+        """
+        Method called when any of the routers can accept messages again
+        after a failed send.  Override.
+        """
+
+    def send(self, message, recipient):
+        """Send message to specified peer.  See ``Router.send()``."""
+        return self.route(recipient).send(message, recipient)
+
+    def send_many(self, messages):
+        """
+        Send multiple messages at once, splitting them among routers.
+        See ``Router.send_many()``.
+        """
+
+        batches = {}
+
+        for i, (message, recipient) in enumerate(messages):
+            batch = batches.setdefault(self.route(recipient), [])
+            batch.append((i, message, recipient))
+
+        results = [False] * len(messages)
+
+        for router, batch in batches.iteritems():
+            sent = router.send_many([item[1:] for item in batch])
+
+            for (i, message, recipient), result in zip(batch, sent):
+                results[i] = result
+
+        return results
+
+
 if __name__ == '__main__':
     server = Router(identity='server')\
                 .bind('tcp://127.0.0.1:4321')
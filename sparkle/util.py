@@ -1,7 +1,7 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
-__all__ = ['call_sync', 'remove_nulls']
+__all__ = ['call_sync', 'remove_nulls', 'is_serialization_failure']
 
 from twisted.internet.threads import blockingCallFromThread
 from twisted.internet import reactor
@@ -14,6 +14,20 @@ def call_sync(fn, *args, **kwargs):
     return blockingCallFromThread(reactor, fn, *args, **kwargs)
 
 
+# SQLSTATE codes of transactions that can be safely retried.
+SERIALIZATION_FAILURES = ('40001', '40P01')
+
+
+def is_serialization_failure(exn):
+    """
+    Determine whether the database exception means that the transaction
+    conflicted with another one and can be retried.
+    """
+
+    return getattr(getattr(exn, 'orig', None), 'pgcode', None) \
+                in SERIALIZATION_FAILURES
+
+
 def remove_nulls(data):
     """
     Recursively remove None values from dictionary.
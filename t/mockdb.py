@@ -0,0 +1,105 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+__doc__ = """
+Database Mocks
+
+Stand-ins for database connections and SQLSoup tables shared by tests,
+along with helpers creating in-memory SQLite databases.
+"""
+
+from sqlalchemy import create_engine
+from sqlsoup import SQLSoup
+
+from sparkle.schema import schema
+
+
+class MockRow(object):
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+class MockColumns(object):
+    def __init__(self, names):
+        self.names = names
+
+    def keys(self):
+        return list(self.names)
+
+
+class MockTable(object):
+    def __init__(self, pkey, columns, rows):
+        self.pkey = pkey
+        self.c = MockColumns(columns)
+        self.info = {}
+        self.rows = rows
+        self.gets = 0
+
+    def get(self, pkey):
+        self.gets += 1
+        return self.rows.get(pkey)
+
+    @property
+    def _table(self):
+        return self
+
+    def insert(self):
+        return self
+
+
+class MockSession(object):
+    def execute(self, table, batch):
+        for columns in batch:
+            table.rows[columns[table.pkey]] = MockRow(**columns)
+
+
+class MockCursor(object):
+    def __init__(self, executed):
+        self.executed = executed
+
+    def execute(self, query, args=None):
+        self.executed.append(query)
+
+    def close(self):
+        pass
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.executed = []
+        self.committed = False
+
+    def cursor(self):
+        return MockCursor(self.executed)
+
+    def commit(self):
+        self.committed = True
+
+
+def make_engine(tables=None):
+    """
+    Create in-memory SQLite engine with given tables.
+
+    Takes mapping of table names to their column definitions.  Without
+    it, all tables of our schema are created with ``uuid`` and ``name``.
+    """
+
+    if tables is None:
+        tables = dict((name, 'uuid TEXT PRIMARY KEY, name TEXT')
+                      for name, table in schema.tables.iteritems()
+                      if not table.virtual)
+
+    engine = create_engine('sqlite://')
+
+    for name, columns in sorted(tables.iteritems()):
+        engine.execute('CREATE TABLE "%s" (%s)' % (name, columns))
+
+    return engine
+
+
+def make_soup(tables):
+    """Create SQLSoup over in-memory SQLite database with given tables."""
+    return SQLSoup(make_engine(tables))
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,35 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from sparkle.api import parse_timestamp, parse_limit, HISTORY_LIMIT
+from sparkle.common import DataError
+
+import pytest
+
+
+def test_parse_timestamp():
+    assert parse_timestamp('2014-01-02T03:04:05Z', []) \
+            == datetime(2014, 1, 2, 3, 4, 5)
+    assert parse_timestamp('2014-01-02 03:04:05.5', []) \
+            == datetime(2014, 1, 2, 3, 4, 5, 500000)
+    assert parse_timestamp('2014-01-02', []) == datetime(2014, 1, 2)
+
+    for value in ['yesterday', '2014-13-01', '']:
+        with pytest.raises(DataError):
+            parse_timestamp(value, [])
+
+
+def test_parse_limit():
+    assert parse_limit('10', []) == 10
+    assert parse_limit('-5', []) == 1
+    assert parse_limit('0', []) == 1
+    assert parse_limit(str(HISTORY_LIMIT * 2), []) == HISTORY_LIMIT
+
+    for value in ['ten', '1.5', None]:
+        with pytest.raises(DataError):
+            parse_limit(value, [])
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,176 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sparkle.dbdict import Children, RowCache, patch_rows, preprocess_patch
+from sparkle.common import PatchError
+
+import pytest
+from sparkle.schema import schema
+from t.mockdb import MockRow, MockTable, MockSession, MockConnection, \
+                     make_soup
+
+
+class MockDB(object):
+    def __init__(self):
+        self.session = MockSession()
+        self.config = MockTable('key', ['key', 'value'], {
+            'motd': MockRow(key='motd', value='hello'),
+        })
+        self.tenant = MockTable('uuid', ['uuid'], {})
+
+    def flush(self):
+        pass
+
+
+def test_row_loaded_once():
+    db = MockDB()
+    root = Children(db, schema.root)
+
+    desired = root['config']['motd']['desired']
+    assert desired['value'] == 'hello'
+    assert 'value' in desired
+    assert 'get' not in desired
+
+    desired.replace('value', 'world')
+    assert root['config']['motd']['desired']['value'] == 'world'
+
+    assert db.config.gets == 1
+
+
+def test_absence_invalidated():
+    db = MockDB()
+    root = Children(db, schema.root)
+
+    assert 'banner' not in root['config']
+    root['config'].add('banner', {'desired': {'value': 'hi'}})
+    assert root['config']['banner']['desired']['value'] == 'hi'
+
+    assert db.config.gets == 2
+
+
+def test_patch_rows():
+    patch = [
+        {'op': 'add', 'path': ['tenant', 't1', 'children', 'instance'],
+         'value': {'i1': {'desired': {},
+                          'children': {'vdisk': {'v1': {}}}}}},
+        {'op': 'move', 'path': ['config', 'a', 'desired', 'value'],
+         'from': ['config', 'b', 'desired', 'value']},
+    ]
+
+    assert patch_rows(patch) == set([('tenant', 't1'), ('instance', 'i1'),
+                                     ('vdisk', 'v1'), ('config', 'a'),
+                                     ('config', 'b')])
+
+
+def test_missing_rows():
+    uuid = '9a3c1e3a-5b44-4bd5-8e6f-6a9d2a3ab0c1'
+    db = MockDB()
+    root = Children(db, schema.root)
+
+    with pytest.raises(KeyError):
+        del root['config']['ghost']
+
+    with pytest.raises(KeyError):
+        root['config']['ghost']
+
+    # User cannot pick uuid of an entity that does not exist.
+    patch = [{'op': 'add', 'path': ['tenant', uuid],
+              'value': {'desired': {'uuid': uuid}}}]
+
+    with pytest.raises(PatchError):
+        preprocess_patch(root, patch)
+
+
+def test_collection_keys():
+    db = make_soup({'tenant': 'uuid TEXT PRIMARY KEY',
+                    'instance': 'uuid TEXT PRIMARY KEY, tenant TEXT'})
+    db.execute("INSERT INTO tenant VALUES ('t1'), ('t2')")
+    db.execute("INSERT INTO instance VALUES ('i1', 't1'), ('i2', 't2'), "
+               "('i3', 't1')")
+
+    instances = Children(db, schema.root)['tenant']['t1']['children']
+    assert sorted(instances['instance']) == ['i1', 'i3']
+
+
+def test_nested_add():
+    from sqlalchemy import event
+
+    db = make_soup({'tenant': 'uuid TEXT PRIMARY KEY',
+                    'instance': 'uuid TEXT PRIMARY KEY, tenant TEXT, '
+                                'name TEXT',
+                    'vdisk': 'uuid TEXT PRIMARY KEY, instance TEXT'})
+
+    statements = []
+
+    @event.listens_for(db.bind, 'before_cursor_execute')
+    def count(conn, cursor, statement, params, context, executemany):
+        if statement.startswith('INSERT'):
+            statements.append(statement)
+
+    tenants = Children(db, schema.root)['tenant']
+    tenants.add('t1', {'children': {'instance': {
+        'i1': {'desired': {'name': 'a'},
+               'children': {'vdisk': {'v1': {}, 'v2': {}}}},
+        'i2': {'desired': {'name': 'b'}},
+    }}})
+
+    assert len(statements) == 3
+    assert sorted(tenants['t1']['children']['instance']) == ['i1', 'i2']
+    assert sorted(db.execute('SELECT uuid, instance FROM vdisk').fetchall()) \
+            == [('v1', 'i1'), ('v2', 'i1')]
+
+
+def emulate_prepared(engine):
+    """Translate EXECUTE of our prepared statements for sqlite."""
+
+    from sqlalchemy import event
+    from sparkle.pool import prepare_statements
+    import re
+
+    conn = MockConnection()
+    prepare_statements(conn, None)
+
+    statements = {}
+
+    for query in conn.executed:
+        name, body = re.match(r'PREPARE (\w+) AS (.*)$', query).groups()
+        statements[name] = body.replace('$1', '?')
+
+    executed = []
+
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def rewrite(conn, cursor, statement, params, context, executemany):
+        match = re.match(r'EXECUTE (\w+)', statement)
+
+        if match:
+            executed.append(match.group(1))
+            statement = statements[match.group(1)]
+
+        return statement, params
+
+    return executed
+
+
+def test_prepared():
+    db = make_soup({'tenant': 'uuid TEXT PRIMARY KEY',
+                    'instance': 'uuid TEXT PRIMARY KEY, tenant TEXT, '
+                                'name TEXT'})
+    db.execute("INSERT INTO tenant VALUES ('t1'), ('t2')")
+    db.execute("INSERT INTO instance VALUES ('i1', 't1', 'a'), "
+               "('i2', 't2', 'b')")
+
+    executed = emulate_prepared(db.bind)
+
+    cache = RowCache(db, prepared=True)
+    root = Children(db, schema.root, cache=cache)
+
+    assert sorted(root['tenant']) == ['t1', 't2']
+    assert sorted(root['tenant']['t1']['children']['instance']) == ['i1']
+    assert cache.load('instance', 'i2').name == 'b'
+
+    assert set(executed) == set(['sparkle_keys_tenant', 'sparkle_get_tenant',
+                                 'sparkle_keys_instance_tenant',
+                                 'sparkle_get_instance'])
+
+
+# vim:set sw=4 ts=4 et:
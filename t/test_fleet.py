@@ -0,0 +1,55 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sparkle.fleet import SimulatedTwilight, make_desired_state, percentile
+
+
+def test_desired_state():
+    changes, layout = make_desired_state(['h1', 'h2', 'h3'], 2, 2)
+
+    assert len(changes) == 2 + 3 + 3 * 2
+    assert layout['h1'] == layout['h3'] != layout['h2']
+
+    changes, layout = make_desired_state(['h1'], 1, 0)
+    assert layout == {'h1': []}
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile(range(100), 99) == 99
+
+
+def update(seq, changes=[], incarnation='i1'):
+    return {'event': 'update', 'incarnation': incarnation, 'seq': seq,
+            'changes': changes}
+
+
+def test_gap_resyncs():
+    peer = SimulatedTwilight('inproc://test-fleet', 'h1', 1, [])
+    sent = []
+    peer.router.send = sent.append
+
+    try:
+        # Updates sent before the first full state are no gaps.
+        peer.on_message(update(1), 'sparkle')
+        peer.on_message(update(2), 'sparkle')
+        assert [m['event'] for m in sent] == ['resync', 'resync']
+        assert peer.resyncs == 0
+
+        peer.on_message(update(0, [('host', 'h1', 'desired', {})]),
+                        'sparkle')
+        peer.on_message(update(1), 'sparkle')
+        assert peer.desired == {('host', 'h1'): {}}
+        assert peer.synced is not None
+
+        # Every gap is counted once, no matter how many updates miss.
+        peer.on_message(update(3), 'sparkle')
+        peer.on_message(update(4), 'sparkle')
+        assert peer.resyncs == 1
+        assert len(sent) == 4
+    finally:
+        peer.stop()
+
+
+# vim:set sw=4 ts=4 et:
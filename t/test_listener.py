@@ -0,0 +1,257 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from simplejson import dumps
+from psycopg2.extensions import POLL_OK, POLL_READ
+from twisted.internet.defer import succeed
+
+import sparkle.listener
+from sparkle.listener import DatabaseListener, decode_notifies, compact
+
+
+Notify = namedtuple('Notify', ['pid', 'channel', 'payload'])
+
+
+def notify(*item):
+    return Notify(0, 'changelog', dumps(item))
+
+
+def change(txid, uuid, action='INSERT'):
+    row = dumps({'uuid': uuid})
+    return notify('u', txid, 'host', action, 'uuid', row)
+
+
+def test_compact():
+    assert compact([('host', 'a', 'desired', {'x': 1}),
+                    ('host', 'b', 'desired', {'x': 1}),
+                    ('host', 'a', 'desired', {'x': 2}),
+                    ('host', 'b', 'desired', None)]) \
+        == [('host', 'a', 'desired', {'x': 2}),
+            ('host', 'b', 'desired', None)]
+
+
+def test_decode_bulk():
+    items = decode_notifies([change(1, 'a'), notify('cork', 1)])
+    assert items[1] == ['cork', 1]
+    assert items[0][:5] == ['u', 1, 'host', 'INSERT', 'uuid']
+
+
+def test_decode_skips_bad():
+    bad = Notify(0, 'changelog', '[broken')
+    items = decode_notifies([change(1, 'a'), bad, notify('cork', 1)])
+    assert len(items) == 2
+
+
+def test_transactions_grouped():
+    listener = DatabaseListener('postgresql:///test')
+    seen = []
+
+    def callback(changes):
+        # Waiters are only released once the changes have been applied.
+        assert not listener.wait(2, 0)
+        seen.append(changes)
+
+    listener.add_callback(callback)
+    listener.register(2)
+
+    for item in decode_notifies([change(1, 'a'), change(1, 'b'),
+                                 change(2, 'a', 'DELETE'),
+                                 notify('cork', 2)]):
+        listener.ingest(item)
+
+    assert listener.txid is None
+    listener.deliver(listener.completed)
+
+    # Both transactions end up in a single compacted batch.
+    assert seen == [[('host', 'a', 'desired', None),
+                     ('host', 'b', 'desired', {'uuid': 'b'})]]
+    assert listener.stats['transactions'] == 2
+    assert listener.stats['compacted'] == 1
+    assert listener.wait(2, 0)
+
+
+class MockCursor(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, query, args=None):
+        if 'ANY' in query:
+            self.result = [row for row in self.rows if row[0] in args[0]]
+        elif 'min' in query:
+            self.result = [(min(row[0] for row in self.rows),)]
+        else:
+            self.result = [row[1:] for row in self.rows if row[0] >= args[0]]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def __iter__(self):
+        return iter(self.result)
+
+
+class MockConnection(object):
+    closed = False
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, name=None):
+        return MockCursor(self.rows)
+
+    def rollback(self):
+        pass
+
+
+def test_changes_fetched():
+    listener = DatabaseListener('postgresql:///test', fetch_changes=True)
+    listener.fetch_conn = MockConnection([
+        (1, 'host', 'INSERT', 'uuid', {'uuid': 'a'}),
+        (2, 'host', 'DELETE', 'uuid', '{"uuid": "a"}'),
+        (3, 'host', 'INSERT', 'uuid', {'uuid': 'c'}),
+    ])
+
+    for item in decode_notifies([notify('t', 1), notify('cork', 1),
+                                 notify('t', 2), notify('cork', 2)]):
+        listener.ingest(item)
+
+    assert listener.load_changes(listener.completed) == [
+        (1, [('host', 'a', 'desired', {'uuid': 'a'})]),
+        (2, [('host', 'a', 'desired', None)]),
+    ]
+
+
+def test_history_loaded():
+    listener = DatabaseListener('postgresql:///test', fetch_changes=True)
+    listener.fetch_conn = MockConnection([
+        (2, 'host', 'INSERT', 'uuid', {'uuid': 'a'}),
+        (3, 'host', 'INSERT', 'uuid', {'uuid': 'b'}),
+    ])
+
+    assert listener.load_history(3) == [('host', 'b', 'desired',
+                                         {'uuid': 'b'})]
+
+    # Older transactions might have been pruned.
+    assert listener.load_history(1) is None
+
+
+class MockAsyncCursor(object):
+    description = None
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.executed.append(sql)
+        self.description = [('txid',)] if 'SELECT' in sql else None
+
+    def fetchall(self):
+        return [(len(self.conn.executed), 1)]
+
+
+class MockAsyncConnection(object):
+    closed = 0
+
+    def __init__(self):
+        self.executed = []
+        self.ready = False
+
+    def cursor(self):
+        return MockAsyncCursor(self)
+
+    def poll(self):
+        return POLL_OK if self.ready else POLL_READ
+
+
+def test_queries_queued():
+    listener = DatabaseListener('postgresql:///test')
+    listener.conn = conn = MockAsyncConnection()
+
+    results = []
+    listener.execute('LISTEN changelog;').addCallback(results.append)
+    listener.cork().addCallback(results.append)
+
+    # Only one query runs at a time.
+    assert conn.executed == ['LISTEN changelog;']
+
+    conn.ready = True
+    listener.doRead()
+
+    assert len(conn.executed) == 2
+    assert results == [None, 2]
+
+    # Cork remembers where to resume from once it is delivered.
+    listener.deliver([(2, [])])
+    assert listener.horizon == 1
+
+
+def test_resync_releases_waiters():
+    listener = DatabaseListener('postgresql:///test')
+    listener.conn = conn = MockAsyncConnection()
+    conn.executed = ['LISTEN changelog;', 'SELECT cork(), ...']
+    conn.ready = True
+
+    reloads = []
+    listener.on_resync = lambda: reloads.append(True)
+    listener.register(2)
+    listener.register(3)
+
+    # Oldest running transaction is the third query's result.
+    listener.resume()
+
+    assert reloads == [True]
+    assert listener.horizon == 3
+    assert listener.wait(2, 0)
+    assert not listener.wait(3, 0)
+
+
+def test_history_releases_waiters(monkeypatch):
+    monkeypatch.setattr(sparkle.listener, 'deferToThread',
+                        lambda fn, *args: succeed(fn(*args)))
+
+    listener = DatabaseListener('postgresql:///test', fetch_changes=True)
+    listener.conn = conn = MockAsyncConnection()
+    conn.executed = ['LISTEN changelog;', 'SELECT cork(), ...']
+    conn.ready = True
+
+    listener.fetch_conn = MockConnection([
+        (1, 'host', 'INSERT', 'uuid', {'uuid': 'a'}),
+        (2, 'host', 'INSERT', 'uuid', {'uuid': 'b'}),
+    ])
+
+    seen = []
+    listener.add_callback(lambda changes: seen.append(changes))
+    listener.horizon = 1
+    listener.register(2)
+
+    listener.resume()
+
+    # History carries no txids, waiters are released by the horizon.
+    assert seen == [[('host', 'a', 'desired', {'uuid': 'a'}),
+                     ('host', 'b', 'desired', {'uuid': 'b'})]]
+    assert listener.horizon == 3
+    assert listener.wait(2, 0)
+
+
+def test_start_disconnected():
+    listener = DatabaseListener('postgresql:///test')
+    reconnects = []
+    listener.reconnect = lambda: reconnects.append(True)
+
+    # Connection lost before start only schedules no reconnect.
+    listener.receive()
+    listener.start()
+
+    try:
+        assert reconnects == [True]
+    finally:
+        listener.corker.stop()
+
+
+# vim:set sw=4 ts=4 et:
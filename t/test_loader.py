@@ -0,0 +1,39 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from psycopg2.extensions import UNICODE, UNICODEARRAY
+
+import sparkle.loader
+from sparkle.schema import schema
+from sparkle.loader import ModelLoader, retained_query
+
+
+def test_retained_query():
+    assert retained_query(schema.tables['host']) == 'SELECT * FROM "host"'
+
+    query = retained_query(schema.tables['event'], '"hash"')
+    assert query.startswith('SELECT "hash" FROM "event" WHERE "mtime" >=')
+    assert query.endswith('ORDER BY "mtime" DESC LIMIT 10000')
+
+
+class MockConnection(object):
+    def set_session(self, **kwargs):
+        self.session = kwargs
+
+
+def test_open_returns_unicode(monkeypatch):
+    conn = MockConnection()
+    registered = []
+
+    def register_type(caster, scope):
+        registered.append((caster, scope))
+
+    monkeypatch.setattr(sparkle.loader, 'connect', lambda dsn: conn)
+    monkeypatch.setattr(sparkle.loader, 'register_type', register_type)
+
+    assert ModelLoader('postgresql:///test').open() is conn
+    assert registered == [(UNICODE, conn), (UNICODEARRAY, conn)]
+    assert conn.session['readonly']
+
+
+# vim:set sw=4 ts=4 et:
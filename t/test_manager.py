@@ -0,0 +1,131 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from twisted.internet import task
+from twisted.internet.defer import succeed, fail, maybeDeferred
+
+from sparkle.manager import Manager
+
+
+class MockRouter(object):
+    def __init__(self, failing=()):
+        self.failing = list(failing)
+        self.sent = []
+
+    def send_many(self, messages):
+        self.sent.append(messages)
+        return [message not in self.failing for message, peer in messages]
+
+
+class MockHost(object):
+    def __init__(self, peer, outbox):
+        self.peer = peer
+        self.outbox = outbox
+        self.results = []
+
+    def delivered(self, results):
+        self.results.append(results)
+
+
+class MockLoader(object):
+    def __init__(self, results):
+        self.results = results
+
+    def load(self):
+        result = self.results.pop(0)
+
+        if isinstance(result, Exception):
+            return fail(result)
+
+        return succeed(result)
+
+
+class MockPlacement(object):
+    def damage(self, row):
+        yield row
+
+    def repair(self, row):
+        if row.desired:
+            yield 'h1'
+
+
+def test_reload_retried(monkeypatch):
+    delays = []
+
+    def defer_later(clock, delay, fn):
+        delays.append(delay)
+        return maybeDeferred(fn)
+
+    monkeypatch.setattr(task, 'deferLater', defer_later)
+
+    manager = Manager(MockRouter(), None, None, None)
+    manager.loader = MockLoader([IOError('gone'), IOError('gone'), {}])
+
+    done = []
+    manager.reload().addCallback(done.append)
+
+    # Result only arrives once the reload have succeeded.
+    assert delays == [15, 15]
+    assert done == [None]
+    assert manager.loader.results == []
+
+
+def test_reload_retried(monkeypatch):
+    delays = []
+
+    def defer_later(clock, delay, fn):
+        delays.append(delay)
+        return maybeDeferred(fn)
+
+    monkeypatch.setattr(task, 'deferLater', defer_later)
+
+    manager = Manager(MockRouter(), None, None, None)
+    manager.loader = MockLoader([IOError('gone'), IOError('gone'), {}])
+
+    done = []
+    manager.reload().addCallback(done.append)
+
+    # Result only arrives once the reload have succeeded.
+    assert delays == [15, 15]
+    assert done == [None]
+    assert manager.loader.results == []
+
+
+def test_flush_hosts():
+    manager = Manager(MockRouter(failing=['d2']), None, None, None)
+    hosts = [MockHost('a', ['a1', 'a2']), MockHost('b', []),
+             MockHost('c', ['c1']), MockHost('d', ['d1', 'd2', 'd3'])]
+
+    manager.flush_hosts(hosts)
+
+    # Everything goes out in a single batch.
+    assert manager.router.sent == [[('a1', 'a'), ('a2', 'a'), ('c1', 'c'),
+                                    ('d1', 'd'), ('d2', 'd'), ('d3', 'd')]]
+
+    # Every host gets results for just it's own messages.
+    assert [host.results for host in hosts] == [
+        [[True, True]], [[]], [[True]], [[True, False, True]],
+    ]
+
+
+def test_modified_rows_sent():
+    manager = Manager(MockRouter(), None, None, None)
+    manager.placement = MockPlacement()
+
+    manager.overlay.load([('host', 'a', 'desired', {'uuid': 'a', 'x': 1})])
+    manager.overlay.commit()
+
+    try:
+        # Modified rows reach their hosts even with placement unchanged.
+        manager.overlay.load([('host', 'a', 'desired', {'uuid': 'a',
+                                                        'x': 2})])
+        manager.overlay.commit()
+
+        message, peer = manager.router.sent[-1][-1]
+        assert message['changes'] == [('host', 'a', 'desired',
+                                       {'uuid': 'a', 'x': 2})]
+    finally:
+        manager.hosts['h1'].keep_alive.stop()
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,79 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sparkle.model import IndexedMapping, OverlayMapping
+
+
+def test_bulk_load_indexes():
+    mapping = IndexedMapping(['host'])
+    mapping['a'] = {'host': 'x'}
+
+    mapping.bulk_load([('a', {'host': 'y'}), ('b', {'host': 'y'}),
+                       ('c', {})])
+
+    assert mapping.lookup('host', 'x') == set()
+    assert mapping.lookup('host', 'y') == set(['a', 'b'])
+    assert len(mapping) == 3
+
+
+def test_overlay_bulk_load():
+    parent = IndexedMapping(['host'])
+    parent['a'] = {'host': 'x'}
+
+    staged = IndexedMapping(['host'])
+    staged.bulk_load([('a', {'host': 'y'}), ('b', {'host': 'y'})])
+
+    overlay = OverlayMapping(parent)
+    overlay.bulk_load(staged)
+
+    # Nothing was staged before, so the mapping have been adopted.
+    assert overlay.overlay is staged
+    assert overlay.lookup('host', 'x') == set()
+
+    overlay.commit()
+    assert parent.lookup('host', 'y') == set(['a', 'b'])
+
+
+def test_bulk_apply():
+    mapping = IndexedMapping(['host'])
+    mapping.bulk_load([('a', {'host': 'x'}), ('b', {'host': 'x'}),
+                       ('c', {'host': 'y'})])
+
+    mapping.bulk_apply({'b': {'host': 'y'}, 'd': {}}, ['a', 'z'])
+
+    assert sorted(mapping) == ['b', 'c', 'd']
+    assert mapping.lookup('host', 'x') == set()
+    assert mapping.lookup('host', 'y') == set(['b', 'c'])
+    assert 'x' not in mapping.idx['host']
+
+
+def test_bulk_apply_conflict():
+    mapping = IndexedMapping(['host'])
+    mapping.bulk_load([('a', {'host': 'x'}), ('b', {'host': 'x'})])
+
+    # Upserts win over deletes of the same key.
+    mapping.bulk_apply({'a': {'host': 'y'}, 'c': {'host': 'y'}},
+                       ['a', 'b', 'b', 'c'])
+
+    assert sorted(mapping) == ['a', 'c']
+    assert mapping['a'] == {'host': 'y'}
+    assert mapping.lookup('host', 'x') == set()
+    assert mapping.lookup('host', 'y') == set(['a', 'c'])
+
+
+def test_overlay_commit():
+    parent = IndexedMapping(['host'])
+    parent.bulk_load([('a', {'host': 'x'}), ('b', {'host': 'x'})])
+
+    overlay = OverlayMapping(parent)
+    overlay['a'] = {'host': 'y'}
+    del overlay['b']
+    overlay['c'] = {'host': 'x'}
+    overlay.commit()
+
+    assert sorted(parent) == ['a', 'c']
+    assert parent.lookup('host', 'x') == set(['c'])
+    assert parent.lookup('host', 'y') == set(['a'])
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,124 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sqlalchemy.exc import DatabaseError
+
+from sparkle.common import DataError, ConflictError
+from sparkle.patch import Pointer
+
+import pytest
+
+
+class MockDiag(object):
+    message_primary = 'failed'
+
+
+class MockError(Exception):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+        self.diag = MockDiag()
+
+
+class FailingDict(dict):
+    def __init__(self, pgcode):
+        self.pgcode = pgcode
+
+    def __delitem__(self, key):
+        raise DatabaseError('DELETE', {}, MockError(self.pgcode))
+
+
+def test_serialization_failure_propagated():
+    with pytest.raises(DatabaseError):
+        Pointer(FailingDict('40001'), ['x']).remove()
+
+    with pytest.raises(DatabaseError):
+        Pointer(FailingDict('40P01'), ['x']).remove()
+
+
+def test_other_failure_converted():
+    with pytest.raises(DataError):
+        Pointer(FailingDict('23505'), ['x']).remove()
+
+
+class MockReactor(object):
+    def callFromThread(self, fn, *args):
+        fn(*args)
+
+
+class MockManager(object):
+    def __init__(self):
+        self.conflicts = []
+
+    def record_write_conflict(self, tables, exhausted):
+        self.conflicts.append((tables, exhausted))
+
+
+def retry_patch(monkeypatch, failures):
+    from sparkle import api
+
+    manager = MockManager()
+    attempts = []
+    delays = []
+
+    patch = [{'op': 'add', 'path': ['config', 'motd'],
+              'value': {'desired': {'value': 'hi'}}}]
+
+    def attempt_patch(manager, copy):
+        assert copy == patch and copy is not patch
+        attempts.append(copy)
+
+        if len(attempts) <= failures:
+            raise DatabaseError('COMMIT', {}, MockError('40001'))
+
+        return {'ok': True}
+
+    monkeypatch.setattr(api, 'attempt_patch', attempt_patch)
+    monkeypatch.setattr(api, 'sleep', delays.append)
+    monkeypatch.setattr(api, 'reactor', MockReactor())
+
+    try:
+        return api.apply_patch(manager, patch), attempts, delays, manager
+    except ConflictError:
+        return None, attempts, delays, manager
+
+
+def test_conflicts_retried(monkeypatch):
+    from sparkle.api import RETRY_DELAY
+
+    result, attempts, delays, manager = retry_patch(monkeypatch, 3)
+
+    assert result == {'ok': True}
+    assert len(attempts) == 4
+    assert manager.conflicts == [(set(['config']), False)] * 3
+
+    # Delays are random, but below an exponentially growing limit.
+    for i, delay in enumerate(delays):
+        assert 0 <= delay <= RETRY_DELAY * 2 ** i
+
+
+def test_conflicts_exhausted(monkeypatch):
+    from sparkle.api import WRITE_RETRIES
+
+    result, attempts, delays, manager = retry_patch(monkeypatch, 100)
+
+    assert result is None
+    assert len(attempts) == WRITE_RETRIES + 1
+    assert len(delays) == WRITE_RETRIES
+    assert manager.conflicts[-1] == (set(['config']), True)
+    assert [exhausted for tables, exhausted in manager.conflicts] \
+            == [False] * WRITE_RETRIES + [True]
+
+
+def test_other_failures_not_retried(monkeypatch):
+    from sparkle import api
+
+    def attempt_patch(manager, patch):
+        raise DatabaseError('COMMIT', {}, MockError('23505'))
+
+    monkeypatch.setattr(api, 'attempt_patch', attempt_patch)
+
+    with pytest.raises(DatabaseError):
+        api.apply_patch(MockManager(), [])
+
+
+# vim:set sw=4 ts=4 et:
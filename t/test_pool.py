@@ -0,0 +1,47 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sqlite3 import connect
+
+from sparkle.pool import MeteredPool, prepare_statements, keys_statement
+from sparkle.schema import schema
+from t.mockdb import MockConnection
+
+
+def test_prepare_statements():
+    conn = MockConnection()
+    prepare_statements(conn, None)
+
+    assert conn.committed
+    assert 'PREPARE sparkle_get_tenant AS SELECT * FROM "tenant" ' \
+           'WHERE "uuid" = $1' in conn.executed
+    assert 'PREPARE sparkle_keys_vdisk_instance AS SELECT "uuid" ' \
+           'FROM "vdisk" WHERE "instance" = $1' in conn.executed
+
+
+def test_keys_statement():
+    # Filtered endpoints have no prepared statement.
+    assert keys_statement(schema.resolve_path(['switch', 'network',
+                                               'address'])) is None
+    assert keys_statement(schema.resolve_path(['tenant'])) \
+            == 'sparkle_keys_tenant'
+
+
+def test_pool_stats():
+    pool = MeteredPool(lambda: connect(':memory:'), pool_size=2,
+                       max_overflow=0)
+
+    first = pool.connect()
+    second = pool.connect()
+
+    stats = pool.get_stats()
+    assert stats['checkouts'] == 2
+    assert stats['checked_out'] == 2
+
+    first.close()
+    second.close()
+
+    assert pool.get_stats()['idle'] == 2
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,137 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, time
+from decimal import Decimal
+from psycopg2.extras import NumericRange
+from twisted.internet.defer import succeed
+
+import sparkle.reconcile
+from sparkle.model import Model, OverlayModel
+from sparkle.reconcile import Reconciler, jsonb_text, bucket_of, \
+                              model_digests
+
+
+def test_jsonb_text():
+    assert jsonb_text({'bb': 1, 'a': None, 'c': [True, 'x"y']}) \
+            == '{"a": null, "c": [true, "x\\"y"], "bb": 1}'
+    assert jsonb_text({'n': Decimal('1.50'), 't': datetime(2014, 1, 2)}) \
+            == '{"n": 1.50, "t": "2014-01-02T00:00:00"}'
+    assert jsonb_text(u'žluťoučk\xfd') \
+            == u'"žluťoučk\xfd"'
+    assert jsonb_text({'r': NumericRange(1, 5)}) == '{"r": "[1,5)"}'
+    assert jsonb_text(NumericRange(None, 5)) == '"(,5)"'
+    assert jsonb_text(NumericRange(empty=True)) == '"empty"'
+
+
+def test_jsonb_fractions():
+    # PostgreSQL drops trailing zeros of fractional seconds.
+    assert jsonb_text(datetime(2014, 1, 2, 3, 4, 5, 500000)) \
+            == '"2014-01-02T03:04:05.5"'
+    assert jsonb_text(datetime(2014, 1, 2, 3, 4, 5, 120)) \
+            == '"2014-01-02T03:04:05.00012"'
+    assert jsonb_text(time(3, 4, 5, 250000)) == '"03:04:05.25"'
+
+
+def test_buckets():
+    assert bucket_of('a', 1) == '0'
+    assert bucket_of(('a', 'b'), 2) == bucket_of('a/b', 2)
+
+    digests = model_digests([('a', {'x': 1}), ('b', {'x': 2})], 0)
+    assert digests[''][0] == 2
+
+
+class MockDB(object):
+    def __init__(self, digests, rows):
+        self.digests = digests
+        self.rows = rows
+        self.params = []
+
+    def execute(self, stmt, params=None):
+        self.params.append(params)
+
+        if 'GROUP BY' in stmt:
+            return [(b, c, t) for b, (c, t) in self.digests.iteritems()]
+        return self.rows
+
+    def rollback(self):
+        pass
+
+
+class MockListener(object):
+    def __init__(self):
+        self.queue = []
+
+    def enqueue(self, fn, *args):
+        self.queue.append((fn, args))
+
+
+class MockManager(object):
+    def __init__(self):
+        self.model = Model()
+        self.overlay = OverlayModel(self.model)
+        self.listener = MockListener()
+
+
+def test_mismatch_confirmed():
+    manager = MockManager()
+    rows = [('a', {'uuid': 'a'})]
+
+    reconciler = Reconciler(manager, depth=1)
+    manager.db = MockDB(model_digests(rows, 1), [])
+    assert reconciler.compare('host', rows) == set()
+
+    # Row missing in the database must differ twice to be repaired.
+    manager.db = MockDB({}, [])
+    differ = reconciler.compare('host', rows)
+    assert differ == set(['0'])
+    assert reconciler.confirm(differ, 'host') == set()
+    assert reconciler.confirm(differ, 'host') == set(['0'])
+    assert reconciler.stats['mismatches'] == 2
+
+    assert reconciler.fetch('host', set(['0'])) == []
+    assert manager.db.params[-1] == {'depth': 1, 'buckets': ['0']}
+
+
+def test_repair_ordered(monkeypatch):
+    monkeypatch.setattr(sparkle.reconcile, 'deferToThread',
+                        lambda fn, *args: succeed(fn(*args)))
+
+    manager = MockManager()
+    manager.db = MockDB({}, [{'uuid': 'a', 'name': 'x'}])
+
+    reconciler = Reconciler(manager, depth=0)
+    done = []
+    reconciler.repair(set(['']), 'host').addCallback(done.append)
+
+    # Nothing is read until deliveries before us are done.
+    assert manager.db.params == []
+    assert done == []
+
+    fn, args = manager.listener.queue.pop()
+    fn(*args)
+
+    assert done == [None]
+    assert manager.model.desired['host']['a'] == {'uuid': 'a', 'name': 'x'}
+    assert reconciler.stats['repairs'] == 1
+
+
+def test_stuck_bucket():
+    manager = MockManager()
+    reconciler = Reconciler(manager, depth=1)
+    reconciler.repaired['host'] = set(['0'])
+
+    # Bucket still differing after its repair is not repaired again.
+    assert reconciler.confirm(set(['0']), 'host') == set()
+    assert reconciler.confirm(set(['0']), 'host') == set()
+    assert reconciler.confirm(set(['0']), 'host') == set()
+    assert reconciler.stats['stuck'] == 1
+
+    # Until it matches once more.
+    assert reconciler.confirm(set(), 'host') == set()
+    assert reconciler.stats['stuck'] == 0
+    assert reconciler.confirm(set(['0']), 'host') == set()
+    assert reconciler.confirm(set(['0']), 'host') == set(['0'])
+
+
+# vim:set sw=4 ts=4 et:
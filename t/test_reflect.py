@@ -0,0 +1,41 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sqlsoup import SQLSoup
+
+from sparkle import reflect
+from t.mockdb import make_engine
+
+
+def test_metadata_cache(tmpdir, monkeypatch):
+    path = str(tmpdir.join('metadata.pickle'))
+    engine = make_engine()
+
+    monkeypatch.setattr(reflect, 'schema_version', lambda engine: 'v1')
+
+    metadata = reflect.load_metadata(engine, path)
+    assert metadata.tables['tenant'].info['columns'] == ('uuid', 'name')
+
+    # Unchanged schema is loaded from the cache.
+    engine.execute('ALTER TABLE tenant ADD COLUMN extra TEXT')
+    cached = reflect.load_metadata(engine, path)
+    assert cached is not metadata
+    assert cached.bind is engine
+    assert cached.tables['tenant'].info['columns'] == ('uuid', 'name')
+
+    # Changed schema is reflected again.
+    monkeypatch.setattr(reflect, 'schema_version', lambda engine: 'v2')
+    fresh = reflect.load_metadata(engine, path)
+    assert fresh.tables['tenant'].info['columns'] == ('uuid', 'name', 'extra')
+
+
+def test_map_tables():
+    engine = make_engine()
+    db = SQLSoup(reflect.load_metadata(engine))
+    reflect.map_tables(db)
+
+    db.tenant.insert(uuid='t1', name='x')
+    assert db.tenant.get('t1').name == 'x'
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,188 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+from sparkle.twilight import validators, Outbox, Twilight
+from simplejson import dumps
+
+
+def test_simple_key():
+    valid = validators['host']
+    assert valid('a', {'uuid': 'a'})
+    assert not valid('a', {'uuid': 'b'})
+    assert not valid('a', {})
+
+
+def test_composite_key():
+    valid = validators['host_disk']
+    assert valid(['h', 'd'], {'host': 'h', 'disk': 'd'})
+    assert valid(('h', 'd'), {'host': 'h', 'disk': 'd'})
+    assert not valid(['h', 'x'], {'host': 'h', 'disk': 'd'})
+    assert not valid(['h'], {'host': 'h', 'disk': 'd'})
+    assert not valid('hd', {'host': 'h', 'disk': 'd'})
+    assert not valid(['h', 'd'], {'host': 'h'})
+
+
+def test_accepted_tables():
+    assert 'host' in validators
+    assert 'instance' not in validators
+
+
+def update(seq, changes):
+    return {'event': 'update', 'seq': seq, 'changes': changes}
+
+
+def test_outbox_merges_updates():
+    outbox = Outbox()
+    keep_alive = []
+
+    assert outbox.push(update(1, keep_alive))
+    assert not outbox.push(update(2, [('host', 'a', 'desired', {'x': 1})]))
+    assert not outbox.push(update(3, [('host', 'a', 'desired', {'x': 2}),
+                                      ('host', 'b', 'desired', None)]))
+
+    assert len(outbox) == 1
+    assert keep_alive == []
+    assert outbox.peek()['seq'] == 1
+    assert outbox.peek()['changes'] == [('host', 'a', 'desired', {'x': 2}),
+                                        ('host', 'b', 'desired', None)]
+
+
+def test_outbox_keeps_order():
+    outbox = Outbox()
+
+    assert outbox.push(update(1, []))
+    assert outbox.push({'event': 'resync'})
+    assert outbox.push(update(2, []))
+
+    outbox.discard_updates()
+    assert list(outbox) == [{'event': 'resync'}]
+
+    outbox.pop()
+    assert not outbox
+
+
+def test_outbox_limits():
+    outbox = Outbox(max_messages=2, max_bytes=1000)
+
+    outbox.push({'event': 'resync'})
+    outbox.push(update(1, []))
+    assert not outbox.overflowing()
+
+    outbox.push(update(2, [('host', 'a', 'desired', {'x': 'y' * 1000})]))
+    assert outbox.overflowing()
+
+    outbox.clear()
+    assert outbox.dropped == 2
+    assert not outbox.overflowing()
+
+
+def test_outbox_bytes():
+    outbox = Outbox()
+
+    outbox.push({'event': 'resync'})
+    outbox.push(update(1, [('host', 'a', 'desired', {'x': 1})]))
+    outbox.push(update(2, [('host', 'a', 'desired', {'x': 'y' * 100}),
+                           ('host', 'b', 'desired', None)]))
+    outbox.push(update(3, [('host', 'a', 'desired', {'x': 2})]))
+
+    actual = sum(len(dumps(message)) for message in outbox)
+    assert abs(outbox.bytes - actual) <= 2
+
+    outbox.pop()
+    assert abs(outbox.bytes - len(dumps(outbox.peek()))) <= 2
+
+    outbox.clear()
+    assert outbox.bytes == 0
+
+
+class MockRouter(object):
+    def __init__(self):
+        self.accepting = 10
+        self.sent = []
+
+    def send_many(self, messages):
+        results = []
+
+        for message, peer in messages:
+            results.append(self.accepting > 0)
+
+            if self.accepting > 0:
+                self.accepting -= 1
+                self.sent.append(message)
+
+        return results
+
+
+class MockManager(object):
+    def __init__(self, max_queue_messages=None):
+        self.max_queue_messages = max_queue_messages
+        self.max_queue_bytes = None
+        self.router = MockRouter()
+
+
+def test_host_requeues_unsent():
+    manager = MockManager()
+    host = Twilight(manager, 'h1')
+
+    try:
+        # Only the first message gets through the congested router.
+        manager.router.accepting = 1
+        host.send({'event': 'resync'}, flush=False)
+        host.send({'event': 'hello'})
+
+        assert manager.router.sent[-1] == {'event': 'resync'}
+        assert list(host.outbox) == [{'event': 'hello'}]
+
+        # The rest follows once the router accepts it.
+        manager.router.accepting = 1
+        host.flush()
+
+        assert manager.router.sent[-1] == {'event': 'hello'}
+        assert len(host.outbox) == 0
+    finally:
+        host.disconnect()
+
+
+def test_host_drops_on_overflow():
+    manager = MockManager(max_queue_messages=2)
+    host = Twilight(manager, 'h1')
+
+    try:
+        manager.router.accepting = 0
+        host.send({'event': 'resync'})
+        host.send({'event': 'resync'})
+        assert len(host.outbox) == 2
+
+        # Peer will notice the gap and ask for a resync.
+        host.send({'event': 'resync'})
+        assert len(host.outbox) == 0
+        assert host.outbox.dropped == 3
+    finally:
+        host.disconnect()
+
+
+def test_host_reports_invalid():
+    host = Twilight(MockManager(), 'h1')
+
+    try:
+        changes = [['host', 'h1', 'current', {'uuid': 'h1'}],
+                   ['instance', 'i1', 'current', {}],
+                   ['host', 'h2', 'current', {'uuid': 'x'}]]
+
+        assert list(host.iter_valid_changes(changes)) == changes[:1]
+        assert host.invalid == 2
+        assert host.invalid_example == ['instance', 'i1', 'current', {}]
+
+        report = host.invalid_report
+        assert report.active()
+    finally:
+        host.disconnect()
+
+    # Dropped host reports right away and leaves no timer behind.
+    assert not report.active()
+    assert host.invalid_report is None
+    assert host.invalid == 0
+    assert not host.keep_alive.running
+
+
+# vim:set sw=4 ts=4 et:
@@ -0,0 +1,285 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+import zmq
+
+from collections import deque
+from decimal import Decimal
+from twisted.internet.defer import succeed
+from sparkle.tzmq import Router, RouterGroup, Inbound, encode, decode, \
+                         negotiate, SERIALIZERS, COMPRESSORS
+from binascii import crc32
+
+
+MESSAGE = {
+    'event': 'update',
+    'seq': 1,
+    'changes': [['host', 'a', 'current', {'uuid': 'a', 'size': 1.5}]],
+}
+
+
+def test_roundtrip():
+    for serializer in SERIALIZERS:
+        for compressor in [None] + COMPRESSORS:
+            data, codec = encode(MESSAGE, serializer, compressor, 0)
+            assert decode(data, codec) == MESSAGE
+
+
+def test_decimal():
+    for serializer in SERIALIZERS:
+        data, codec = encode({'size': Decimal('1.50')}, serializer)
+        assert decode(data, codec) == {'size': 1.5}
+
+
+def test_threshold():
+    data, codec = encode(MESSAGE, 'json', 'zlib', 1 << 20)
+    assert codec == 'json'
+
+    data, codec = encode(MESSAGE, 'json', 'zlib', 16)
+    assert codec == 'json+zlib'
+
+
+def test_negotiate():
+    assert negotiate(None) is None
+    assert negotiate('bson') is None
+    assert negotiate('json') == ('json', None)
+    assert negotiate('json,zlib') == ('json', 'zlib')
+    assert negotiate(','.join(SERIALIZERS + COMPRESSORS)) \
+            == (SERIALIZERS[0], COMPRESSORS[0])
+
+
+def make_item(sender, message, done=True):
+    item = Inbound(sender, None)
+    item.done = done
+    item.message = message
+    return item
+
+
+def test_fair_dispatch():
+    router = Router(read_budget=4)
+    received = []
+
+    try:
+        router.on_message = lambda message, sender: \
+                                received.append((sender, message))
+
+        router.inbox = {
+            'a': deque([make_item('a', i) for i in [1, 2, 3, 4]]),
+            'b': deque([make_item('b', 1)]),
+        }
+        router.ready = deque(['a', 'b'])
+
+        router.dispatch()
+        assert received == [('a', 1), ('b', 1), ('a', 2), ('a', 3)]
+        assert list(router.ready) == ['a']
+
+        router.dispatch()
+        assert received[-1] == ('a', 4)
+        assert not router.ready and not router.inbox
+    finally:
+        router.shutdown()
+
+
+def test_ordered_dispatch():
+    router = Router()
+    received = []
+
+    try:
+        router.on_message = lambda message, sender: \
+                                received.append((sender, message))
+
+        pending = make_item('a', None, done=False)
+        router.inbox = {'a': deque([make_item('a', 1), pending,
+                                    make_item('a', 3)])}
+        router.ready = deque(['a'])
+
+        router.dispatch()
+        assert received == [('a', 1)]
+        assert not router.ready
+
+        router.completed(router.decoded({'x': 2}, pending))
+        assert list(router.ready) == ['a']
+
+        router.dispatch()
+        assert received == [('a', 1), ('a', {'x': 2}), ('a', 3)]
+    finally:
+        router.shutdown()
+
+
+def test_failed_completion():
+    router = Router()
+
+    def broken(message, item):
+        raise TypeError('broken')
+
+    try:
+        pending = make_item('a', None, done=False)
+        router.inbox = {'a': deque([pending, make_item('a', 2)])}
+        router.decoded = broken
+
+        router.track(succeed({'x': 1}), pending)
+
+        # The sender must not stall behind the failed item.
+        assert pending.done and pending.message is None
+        assert list(router.ready) == ['a']
+        assert router.stats['invalid'] == 1
+    finally:
+        router.shutdown()
+
+
+def test_raising_handler():
+    router = Router()
+    received = []
+
+    def handler(message, sender):
+        received.append((sender, message))
+
+        if message == 1:
+            raise ValueError('broken')
+
+    try:
+        router.on_message = handler
+        router.inbox = {
+            'a': deque([make_item('a', 1), make_item('a', 2)]),
+            'b': deque([make_item('b', 1)]),
+        }
+        router.ready = deque(['a', 'b'])
+
+        router.dispatch()
+        assert received == [('a', 1), ('b', 1), ('a', 2)]
+        assert not router.ready and not router.inbox
+    finally:
+        router.shutdown()
+
+
+def test_read_coalesced():
+    router = Router()
+
+    try:
+        router.schedule_read()
+        planned = router.reading
+
+        # Only a single read is ever planned.
+        router.schedule_read()
+        router.send_many([])
+        assert router.reading is planned
+
+        # Reading cancels the planned read.
+        router.doRead()
+        assert router.reading is None
+        assert not planned.active()
+    finally:
+        router.shutdown()
+
+
+class MockSocket(object):
+    def __init__(self, socket, errors):
+        self.socket = socket
+        self.errors = errors
+        self.sent = []
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def send_multipart(self, frames, flags=0):
+        if frames[0] in self.errors:
+            raise zmq.ZMQError(self.errors[frames[0]])
+
+        self.sent.append((frames[0], frames[1]))
+
+
+def test_send_many_skips_failed():
+    router = Router()
+    socket = router.socket
+    router.socket = MockSocket(socket, {'b': zmq.EHOSTUNREACH,
+                                        'c': zmq.EAGAIN})
+
+    try:
+        results = router.send_many([('1', 'a'), ('2', 'b'), ('3', 'a'),
+                                    ('4', 'b'), ('5', 'c')])
+
+        # Only messages for the failed recipients are skipped.
+        assert results == [True, False, True, False, False]
+        assert [recipient for recipient, data in router.socket.sent] \
+                == ['a', 'a']
+
+        # Full queue makes us watch for the socket to become writable.
+        assert router.retry is not None
+    finally:
+        router.socket = socket
+        router.shutdown()
+
+
+class MockRouter(object):
+    def __init__(self, full=()):
+        self.sent = []
+        self.full = set(full)
+        self.stats = {'received': 1, 'dispatched': 2}
+
+    def send(self, message, recipient):
+        return self.send_many([(message, recipient)])[0]
+
+    def send_many(self, messages):
+        results = []
+
+        for message, recipient in messages:
+            self.sent.append((message, recipient))
+            results.append(recipient not in self.full)
+
+        return results
+
+    def shutdown(self):
+        pass
+
+
+def test_group_routes_replies():
+    routers = [MockRouter(), MockRouter()]
+    group = RouterGroup(routers)
+    received = []
+    group.on_message = lambda message, sender: \
+                            received.append((message, sender))
+
+    # Peers are remembered on the router we have heard them from.
+    routers[1].on_message({'event': 'hello'}, 'a')
+    assert received == [({'event': 'hello'}, 'a')]
+    assert group.route('a') is routers[1]
+
+    assert group.send({'event': 'reply'}, 'a')
+    assert routers[1].sent == [({'event': 'reply'}, 'a')]
+    assert routers[0].sent == []
+
+    # Unknown peers are spread by hash of their identity.
+    assert group.route('b') is routers[crc32('b') % 2]
+
+    assert group.stats == {'received': 2, 'dispatched': 4}
+
+
+def test_group_send_many():
+    routers = [MockRouter(), MockRouter(full=['c'])]
+    group = RouterGroup(routers)
+    group.routes = {'a': routers[0], 'b': routers[1], 'c': routers[1]}
+
+    results = group.send_many([(1, 'a'), (2, 'b'), (3, 'c'), (4, 'a')])
+
+    # Results are reported in the original order.
+    assert results == [True, True, False, True]
+    assert routers[0].sent == [(1, 'a'), (4, 'a')]
+    assert routers[1].sent == [(2, 'b'), (3, 'c')]
+
+
+def test_group_writable():
+    routers = [Router(), Router()]
+    group = RouterGroup(routers)
+    notified = []
+    group.on_writable = lambda: notified.append(True)
+
+    try:
+        for router in routers:
+            router.check_writable()
+
+        assert notified == [True, True]
+    finally:
+        group.shutdown()
+
+
+# vim:set sw=4 ts=4 et: